@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Collection cost at 10, 1k, 10k and 100k threads, without root and
+without busy processes.
+
+Taskstats replies come from FakeTaskstatsSocket, a stand-in for the
+netlink socket under a real iotop.netlink.Connection: it answers every
+TASKSTATS_CMD_GET it is sent with a valid reply whose counters grow each
+round, so the whole path from request building to the task table runs.
+/proc is a fake tree in a temporary directory: THREADS_PER_PROCESS
+threads per matching process and as many processes again that do not
+match, for discovery to skip.
+
+    collect      one ProcessCounter.update_tasks_stats round over all
+                 processes, per thread and per process
+    collect_proc_io  the same round with proc_io, I/O from /proc/<pid>/io
+    fake_kernel  what the fake socket alone costs of that, per thread
+    discover     ProcessDiscovery.discover, the first (cold) and a later
+                 (cached) pass
+    aggregate    ProcessMonitor._trans_id_to_name over all processes
+
+Prints one JSON object per line, for tracking over time:
+
+    python benchmarks/bench_collect.py [threads ...] > results.ndjson
+"""
+import os
+import sys
+import json
+import errno
+import shutil
+import socket
+import struct
+import tempfile
+import timeit
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'process_monitor'))
+
+from iotop.netlink import Connection, Nested, U32Attr, Attr, NLMSG_MIN_TYPE
+from taskstats import Stats, ProcessCounter, TaskStatsTable, TaskStatsBatch
+from taskstats import TASKSTATS_TYPE_AGGR_PID, TASKSTATS_TYPE_PID
+from taskstats import TASKSTATS_TYPE_STATS
+from procfs import ProcReader
+from discovery import ProcessDiscovery
+
+SIZES = (10, 1000, 10000, 100000)
+THREADS_PER_PROCESS = 100
+NAMES = ('java', 'mysqld', 'nginx', 'redis-server')
+FAMILY_ID = NLMSG_MIN_TYPE + 1
+TASKSTATS_SIZE = 416
+_nlmsghdr = struct.Struct('IHHII')
+
+
+def _reply_template():
+    taskstats = bytearray(TASKSTATS_SIZE)
+    struct.pack_into('H', taskstats, 0, 10)
+    aggr = Nested(TASKSTATS_TYPE_AGGR_PID,
+                  [U32Attr(TASKSTATS_TYPE_PID, 0),
+                   Attr(TASKSTATS_TYPE_STATS, bytes(taskstats))])
+    payload = struct.pack('BBxx', 1, 1) + aggr._dump()
+    return bytearray(_nlmsghdr.pack(len(payload) + 16, FAMILY_ID, 0, 0, 0) + payload)
+
+
+class FakeTaskstatsSocket(object):
+    """Answers TASKSTATS_CMD_GET requests like the kernel would
+
+    Replies are queued while the requests are sent, recvfrom() raises
+    EAGAIN once they are drained.  Every round (see next_round) adds to
+    the counters of every task.
+    """
+    # offsets in the reply: the tid in the PID attribute, the taskstats
+    TID_OFFSET = 16 + 4 + 4 + 4
+    STATS_OFFSET = 16 + 4 + 4 + 8 + 4
+
+    def __init__(self):
+        self._replies = deque()
+        self._template = _reply_template()
+        self._round = 0
+        self._counters = [(self.STATS_OFFSET + offset, step)
+                          for (step, (name, offset)) in
+                          enumerate(Stats.members_offsets, 1)]
+
+    def next_round(self):
+        self._round += 1
+
+    def reply(self, seq, tid):
+        reply = self._template
+        _nlmsghdr.pack_into(reply, 0, len(reply), FAMILY_ID, 0, seq, 0)
+        struct.pack_into('I', reply, self.TID_OFFSET, tid)
+        for (offset, step) in self._counters:
+            struct.pack_into('Q', reply, offset, self._round * step * 4096)
+        return str(reply)
+
+    def send(self, data):
+        offset = 0
+        while offset < len(data):
+            (length, msg_type, flags, seq, pid) = _nlmsghdr.unpack_from(data, offset)
+            # genl header, attribute header, then the u32 tid
+            tid = struct.unpack_from('I', data, offset + 16 + 4 + 4)[0]
+            self._replies.append(self.reply(seq, tid))
+            offset += length
+
+    def recvfrom(self, bufs):
+        if not self._replies:
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        return (self._replies.popleft(), (0, 0))
+
+    def setblocking(self, flag):
+        pass
+
+
+class FakeConnection(Connection):
+
+    def __init__(self):
+        self.descriptor = FakeTaskstatsSocket()
+        self.pid = os.getpid()
+        self.groups = 0
+        self._seq = 0
+        self.unexpected = None
+
+
+def _stat_line(pid, comm, num_threads):
+    # fields 3 on, see proc(5): rss is 24, vsize 23, stime 15, utime 14,
+    # num_threads 20 and starttime 22
+    fields = ['S'] + ['0'] * 22
+    fields[14 - 3] = '1000'
+    fields[15 - 3] = '500'
+    fields[20 - 3] = str(num_threads)
+    fields[22 - 3] = str(pid * 7)
+    fields[23 - 3] = str(1 << 30)
+    fields[24 - 3] = '25000'
+    return '%d (%s) %s\n' % (pid, comm, ' '.join(fields))
+
+
+def _io_text(pid):
+    return ('rchar: %d\nwchar: %d\nsyscr: 10\nsyscw: 10\nread_bytes: %d\n'
+            'write_bytes: %d\ncancelled_write_bytes: 0\n') % (pid * 3, pid * 5, pid, pid * 2)
+
+
+def build_proc_tree(root, threads):
+    """Returns {pid: name} of the matching processes created under root"""
+    processes = max(1, threads / THREADS_PER_PROCESS)
+    per_process = threads / processes
+    matching = {}
+    tid = 100000
+    for i in xrange(processes * 2):
+        pid = 1000 + i
+        if i < processes:
+            name = NAMES[i % len(NAMES)]
+            comm = name[:15]
+            cmdline = '/usr/bin/%s\0--some\0--args\0' % name
+            nthreads = per_process
+            matching[pid] = name
+        else:
+            comm = 'other'
+            cmdline = '/usr/sbin/other-daemon-%d\0' % i
+            nthreads = 1
+        os.makedirs(os.path.join(root, str(pid), 'task', str(pid)))
+        for j in xrange(nthreads - 1):
+            os.mkdir(os.path.join(root, str(pid), 'task', str(tid)))
+            tid += 1
+        with open(os.path.join(root, str(pid), 'stat'), 'w') as f:
+            f.write(_stat_line(pid, comm, nthreads))
+        with open(os.path.join(root, str(pid), 'cmdline'), 'w') as f:
+            f.write(cmdline)
+        with open(os.path.join(root, str(pid), 'io'), 'w') as f:
+            f.write(_io_text(pid))
+    return matching
+
+
+def _best(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_collect(root, matching, threads):
+    connection = FakeConnection()
+    batch = TaskStatsBatch(connection, FAMILY_ID)
+    table = TaskStatsTable()
+    reader = ProcReader(root=root)
+    counters = [ProcessCounter(pid, table, reader, batch) for pid in sorted(matching)]
+
+    def collect():
+        connection.descriptor.next_round()
+        return [counter.update_tasks_stats() for counter in counters]
+
+    collect()
+    results = collect()
+    assert all(r[4] and r[4].read_bytes > 0 for r in results)
+    t = _best(collect)
+
+    fake = connection.descriptor
+    def fake_kernel():
+        for tid in xrange(threads):
+            fake.reply(tid, tid)
+    fake_t = _best(fake_kernel)
+
+    yield {'bench': 'collect', 'threads': threads, 'processes': len(counters),
+           'seconds': t, 'per_thread_us': t / threads * 1e6,
+           'per_process_us': t / len(counters) * 1e6}
+    yield {'bench': 'fake_kernel', 'threads': threads, 'seconds': fake_t,
+           'per_thread_us': fake_t / threads * 1e6}
+
+    proc_io_counters = [ProcessCounter(pid, table, reader, batch, proc_io=True)
+                        for pid in sorted(matching)]
+    proc_io = lambda: [counter.update_tasks_stats() for counter in proc_io_counters]
+    proc_io()
+    proc_io_t = _best(proc_io)
+    yield {'bench': 'collect_proc_io', 'threads': threads,
+           'processes': len(proc_io_counters), 'seconds': proc_io_t,
+           'per_thread_us': proc_io_t / threads * 1e6,
+           'per_process_us': proc_io_t / len(proc_io_counters) * 1e6}
+
+    id_m = {}
+    for (pid, result) in zip(sorted(matching), results):
+        (cpu_usage, num_threads, vm, rss, delta, duration) = result
+        id_m[pid] = {'delta': delta, 'duration': duration, 'vm': vm, 'rss': rss,
+                     'cpu_usage': cpu_usage, 'num_threads': int(num_threads)}
+    aggregate = bench_aggregate(matching, id_m)
+    if aggregate is not None:
+        aggregate.update({'threads': threads})
+        yield aggregate
+    reader.close()
+
+
+def bench_discover(root, matching, threads):
+    discovery = ProcessDiscovery(NAMES, root=root)
+    cold = _best(lambda: ProcessDiscovery(NAMES, root=root).discover())
+    assert discovery.discover() == matching
+    warm = _best(discovery.discover)
+    yield {'bench': 'discover', 'threads': threads, 'processes': len(matching) * 2,
+           'cold_seconds': cold, 'warm_seconds': warm}
+
+
+def bench_aggregate(matching, id_m):
+    try:
+        from monitor import ProcessMonitor
+    except ImportError, e:
+        # the monitor needs requests
+        print >>sys.stderr, 'skipping aggregate: %s' % e
+        return None
+
+    class Monitor(object):
+        _process_id_name_m = matching
+        _trans_id_to_name = ProcessMonitor._trans_id_to_name.im_func
+
+    monitor = Monitor()
+    t = _best(lambda: monitor._trans_id_to_name(id_m))
+    return {'bench': 'aggregate', 'processes': len(id_m), 'seconds': t,
+            'per_process_us': t / len(id_m) * 1e6}
+
+
+def main():
+    sizes = map(int, sys.argv[1:]) or SIZES
+    for threads in sizes:
+        root = tempfile.mkdtemp(prefix='fakeproc')
+        try:
+            matching = build_proc_tree(root, threads)
+            for result in bench_collect(root, matching, threads):
+                print json.dumps(result, sort_keys=True)
+            for result in bench_discover(root, matching, threads):
+                print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Per-reply parse cost of a TASKSTATS_CMD_GET reply.
+
+`legacy` is the slicing parser netlink.py used before (every attribute
+re-slices the remaining data and copies its payload), `memoryview` is the
+current offset-walking parser.  Both go from the raw datagram to a Stats.
+
+The `attrs` case parses a flat list of many attributes, where re-slicing
+the remainder makes the legacy parser quadratic in the reply size.
+
+    python benchmarks/bench_netlink_parse.py [iterations]
+"""
+import os
+import sys
+import struct
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'process_monitor'))
+
+from iotop.netlink import Message, parse_attributes
+from iotop.netlink import NLMSG_MIN_TYPE, U32Attr, Nested, Attr
+from iotop.genetlink import _genl_hdr_parse
+from taskstats import Stats, TASKSTATS_TYPE_AGGR_PID, TASKSTATS_TYPE_PID
+from taskstats import TASKSTATS_TYPE_STATS
+
+TASKSTATS_SIZE = 416
+
+
+def build_reply(tid=4242):
+    taskstats = bytearray(TASKSTATS_SIZE)
+    struct.pack_into('H', taskstats, 0, 10)
+    for name, offset in Stats.members_offsets:
+        struct.pack_into('Q', taskstats, offset, offset * 1000)
+    aggr = Nested(TASKSTATS_TYPE_AGGR_PID,
+                  [U32Attr(TASKSTATS_TYPE_PID, tid),
+                   Attr(TASKSTATS_TYPE_STATS, bytes(taskstats))])
+    payload = struct.pack('BBxx', 1, 1) + aggr._dump()
+    hdr = struct.pack('IHHII', len(payload) + 16, NLMSG_MIN_TYPE + 1, 0, 1, 0)
+    return hdr + payload
+
+
+def _legacy_parse_attributes(data):
+    attrs = {}
+    while len(data):
+        attr_len, attr_type = struct.unpack("HH", data[:4])
+        attrs[attr_type] = Attr(attr_type, data[4:attr_len])
+        attr_len = ((attr_len + 4 - 1) & ~3)
+        data = data[attr_len:]
+    return attrs
+
+
+def _legacy_stats(task_stats_buffer):
+    stats = Stats.__new__(Stats)
+    sd = stats.__dict__
+    for name, offset in Stats.members_offsets:
+        data = task_stats_buffer[offset:offset + 8]
+        sd[name] = struct.unpack('Q', data)[0]
+    if not Stats.has_blkio_delay_total:
+        Stats.has_blkio_delay_total = stats.blkio_delay_total != 0
+    return stats
+
+
+def parse_legacy(contents):
+    msg = Message(0, 0, 0, contents[16:])
+    packet = msg.payload
+    _genl_hdr_parse(packet[:4])
+    attrs = _legacy_parse_attributes(packet[4:])
+    nested = attrs[TASKSTATS_TYPE_AGGR_PID].nested_legacy()
+    data = nested[TASKSTATS_TYPE_STATS].data
+    struct.unpack('H', data[:2])
+    return _legacy_stats(data)
+
+
+def parse_memoryview(contents):
+    msg = Message(0, 0, 0, memoryview(contents)[16:])
+    packet = msg.payload
+    _genl_hdr_parse(packet)
+    attrs = parse_attributes(packet, 4)
+    nested = attrs[TASKSTATS_TYPE_AGGR_PID].nested()
+    data = nested[TASKSTATS_TYPE_STATS]
+    data.u16()
+    return Stats(data.buf, data.offset)
+
+
+Attr.nested_legacy = lambda self: _legacy_parse_attributes(self.data)
+
+
+def build_attrs(count=256, size=64):
+    return b''.join(Attr(i, b'x' * size)._dump() for i in range(count))
+
+
+def _bench(name, func, arg, iterations):
+    best = min(timeit.repeat(lambda: func(arg), number=iterations, repeat=3))
+    print '%-24s %8.2f us/reply' % (name, best / iterations * 1e6)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    reply = build_reply()
+    assert parse_legacy(reply).__dict__ == parse_memoryview(reply).__dict__
+    _bench('taskstats legacy', parse_legacy, reply, iterations)
+    _bench('taskstats memoryview', parse_memoryview, reply, iterations)
+
+    attrs = build_attrs()
+    iterations = max(iterations / 100, 1)
+    _bench('attrs legacy', _legacy_parse_attributes, attrs, iterations)
+    _bench('attrs memoryview', parse_attributes, attrs, iterations)
+
+
+if __name__ == '__main__':
+    main()
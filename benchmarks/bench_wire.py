@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Size and CPU cost of a report: JSON (what the reporter sends without
+wire_format, gzipped) against the binary format of wire.py.
+
+Reports are steady state: the same services every minute with values
+moving a little, which is what the delta encoding is for.  `encode` goes
+from the documents to the body, `decode` from the body to the documents
+as the gateway does it.
+
+    python benchmarks/bench_wire.py [services] [iterations]
+"""
+import os
+import sys
+import json
+import zlib
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'process_monitor'))
+
+import wire
+from reporter import gzip_compress
+
+
+def build_docs(services, reports):
+    rnd = random.Random(42)
+    data = dict(('service%d' % i, {
+        'read_bytes': rnd.randrange(1 << 20),
+        'write_bytes': rnd.randrange(1 << 24),
+        'rss': rnd.randrange(1 << 32),
+        'vm': rnd.randrange(1 << 34),
+        'cpu_usage': round(rnd.random() * 400, 3),
+        'num_threads': rnd.randrange(500),
+        'num_processes': rnd.randrange(1, 8),
+    }) for i in xrange(services))
+    docs = []
+    for t in xrange(reports):
+        l = []
+        for (service, values) in sorted(data.iteritems()):
+            values['read_bytes'] = max(0, values['read_bytes'] + rnd.randrange(-4096, 4096))
+            values['write_bytes'] = max(0, values['write_bytes'] + rnd.randrange(-65536, 65536))
+            values['rss'] += rnd.randrange(-1 << 16, 1 << 16)
+            values['cpu_usage'] = round(max(0, values['cpu_usage'] + rnd.uniform(-5, 5)), 3)
+            l.append({'service': service, 'data': dict(values)})
+        docs.append({'host': 'host.example.com', 'time': 1500000000 + 60 * t, 'list': l})
+    return docs
+
+
+def json_encode(doc):
+    return gzip_compress(json.dumps([doc]))
+
+
+def json_decode(body):
+    return json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+
+def _bench(name, func, args, iterations):
+    best = min(timeit.repeat(lambda: [func(arg) for arg in args],
+                             number=iterations, repeat=3))
+    print '%-24s %8.2f us/report' % (name, best / iterations / len(args) * 1e6)
+
+
+def main():
+    services = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    docs = build_docs(services, 60)
+
+    # a long lived stream: one keyframe, then deltas
+    encoder = wire.Encoder()
+    wire_bodies = []
+    for doc in docs:
+        wire_bodies.append(encoder.encode([doc]))
+        encoder.commit()
+    decoder = wire.Decoder()
+    assert [decoder.decode(body)[0] for body in wire_bodies] == docs
+    # and the hottest threads of an entry travel with it
+    entry = dict(docs[0]['list'][0], threads=[{'tid': 1, 'comm': 'worker', 'cpu_usage': 12.5}])
+    doc = dict(docs[0], list=[entry] + docs[0]['list'][1:])
+    assert wire.Decoder().decode(wire.Encoder().encode([doc]))[0] == doc
+    json_bodies = [json_encode(doc) for doc in docs]
+
+    print '%d services per report' % services
+    print '%-24s %8d bytes/report' % ('json', sum(len(json.dumps([doc])) for doc in docs) / len(docs))
+    print '%-24s %8d bytes/report' % ('json gzip', sum(map(len, json_bodies)) / len(docs))
+    print '%-24s %8d bytes (keyframe)' % ('wire', len(wire_bodies[0]))
+    print '%-24s %8d bytes/report' % ('wire', sum(map(len, wire_bodies[1:])) / (len(docs) - 1))
+
+    def wire_encode(doc):
+        body = encoder.encode([doc])
+        encoder.commit()
+        return body
+
+    def wire_decode(body):
+        # decoding the same stream over and over, from its keyframe on
+        if body is wire_bodies[0]:
+            decoder._streams.clear()
+        return decoder.decode(body)
+
+    _bench('encode json gzip', json_encode, docs, iterations)
+    _bench('encode wire', wire_encode, docs, iterations)
+    _bench('decode json gzip', json_decode, json_bodies, iterations)
+    _bench('decode wire', wire_decode, wire_bodies, iterations)
+
+
+if __name__ == '__main__':
+    main()
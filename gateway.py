@@ -1,36 +1,671 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import gc
 import json
+import time
+import mmap
+import struct
+import marshal
+import bisect
+import itertools
+from array import array
+from threading import Thread, Lock, Event
+import zlib
 import web
 
+from process_monitor import wire
+
 urls = (
     "/i/update",    "i_update",
+    "/i/bulk",      "i_bulk",
     "/o/info",     "o_info",
     "/o/view",     "o_view",
+    "/o/series",   "o_series",
+    "/o/top",      "o_top",
+    "/o/stream",   "o_stream",
 )
 
 app = web.application(urls, globals())
 
 
-class Storage(object):
+class Tier(object):
+    """A ring of at most `capacity` samples, or of rollups over `width`
+    seconds.
+
+    Times and values live in typed arrays, the values of a slot side by
+    side, one per field.  The arrays grow by a slot per sample until the
+    ring is full, so a short lived key costs only what it stored.  A
+    rollup slot keeps min, max and sum/count of its bucket and is
+    updated in place by every sample falling into it, so nothing is
+    recomputed on read.  Samples must come in time order.
+    """
+    # there are a few per key
+    __slots__ = ('_width', '_capacity', '_nfields', '_times', '_sum', '_min',
+                 '_max', '_count', '_head')
+
+    def __init__(self, width, capacity, nfields):
+        self._width = width
+        self._capacity = capacity
+        self._nfields = nfields
+        self._times = array('d')
+        self._sum = array('f')
+        if width:
+            self._min = array('f')
+            self._max = array('f')
+            self._count = array('l')
+        self._head = -1
+
+    def add(self, timestamp, values):
+        if self._width:
+            timestamp -= timestamp % self._width
+            if self._times and self._times[self._head] == timestamp:
+                self._merge(values)
+                return
+        values = array('f', values)
+        if len(self._times) < self._capacity:
+            # not full yet, the head is the last slot
+            self._head += 1
+            self._times.append(timestamp)
+            self._sum.extend(values)
+            if self._width:
+                self._min.extend(values)
+                self._max.extend(values)
+                self._count.append(1)
+            return
+        self._head = (self._head + 1) % self._capacity
+        self._times[self._head] = timestamp
+        base = self._head * self._nfields
+        self._sum[base:base + self._nfields] = values
+        if self._width:
+            self._min[base:base + self._nfields] = values
+            self._max[base:base + self._nfields] = values
+            self._count[self._head] = 1
+
+    def _merge(self, values):
+        base = self._head * self._nfields
+        for (i, value) in enumerate(values, base):
+            self._sum[i] += value
+            if value < self._min[i]:
+                self._min[i] = value
+            if value > self._max[i]:
+                self._max[i] = value
+        self._count[self._head] += 1
+
+    def query(self, fields, start, end):
+        """Returns the slots in [start, end] as columns
+
+        {'t': [...], 'data': {field: [...]}} for raw samples and
+        {'t': [...], 'data': {field: {'min': [...], 'max': [...],
+        'avg': [...]}}} for rollups.
+        """
+        n = self._nfields
+        slots = [slot % self._capacity for slot in
+                 xrange(self._head - len(self._times) + 1, self._head + 1)]
+        slots = [slot for slot in slots if start <= self._times[slot] <= end]
+        data = {}
+        for (f, field) in enumerate(fields):
+            if self._width:
+                data[field] = {
+                    'min': [self._min[slot * n + f] for slot in slots],
+                    'max': [self._max[slot * n + f] for slot in slots],
+                    'avg': [self._sum[slot * n + f] / self._count[slot]
+                            for slot in slots],
+                }
+            else:
+                data[field] = [self._sum[slot * n + f] for slot in slots]
+        return {'t': [self._times[slot] for slot in slots], 'data': data}
+
+
+class Series(object):
+    """History of one (host, service): raw samples plus 1m and 1h rollups.
+
+    Memory grows with the samples up to a bound, about 30KB with the
+    default tiers, however long the gateway runs.  The raw tier only
+    keeps the last hour at the monitor's default 60s interval, the 1m
+    rollups hold the same samples for longer; it is finer for the
+    services sampled more often.
+    """
+    FIELDS = ('read_bytes', 'write_bytes', 'rss', 'vm', 'cpu_usage',
+              'num_threads', 'num_processes')
+    # (name, rollup width in seconds or 0 for raw, slots); a tier with 0
+    # slots is not kept
+    TIERS = (('raw', 0, 60), ('1m', 60, 120), ('1h', 3600, 168))
+    __slots__ = ('_tiers', '_last')
+
+    def __init__(self, tiers=TIERS):
+        self._tiers = dict((name, Tier(width, capacity, len(self.FIELDS)))
+                           for (name, width, capacity) in tiers if capacity)
+        self._last = None
+
+    @classmethod
+    def wants(cls, data):
+        """Whether data has any of the fields a Series keeps"""
+        for field in cls.FIELDS:
+            if field in data:
+                return True
+        return False
+
+    def add(self, timestamp, data):
+        if self._last is not None and timestamp < self._last:
+            # out of order, the ring buffers only append
+            return
+        self._last = timestamp
+        values = [float(data.get(field) or 0) for field in self.FIELDS]
+        for tier in self._tiers.itervalues():
+            tier.add(timestamp, values)
+
+    def query(self, tier, start, end):
+        """Returns Tier.query of tier, None if it is not kept"""
+        tier = self._tiers.get(tier)
+        if tier is None:
+            return None
+        return tier.query(self.FIELDS, start, end)
+
+
+def series_tiers(spec):
+    """Returns Series.TIERS with the slots of spec, "raw=60,1h=0" e.g."""
+    slots = dict(item.split('=') for item in spec.split(',') if item)
+    return tuple((name, width, int(slots.get(name, capacity)))
+                 for (name, width, capacity) in Series.TIERS)
+
+
+class Ranking(object):
+    """The hosts of a service ordered by the latest value of a metric
+
+    A sorted list of (value, host), kept sorted on every update by bisect,
+    so the top n is a slice.  It ranks all hosts rather than a bounded
+    top K, so a host dropping out of the top is replaced exactly.
+
+    A host whose value was not updated for max_age seconds has stopped
+    reporting; top() skips it and drops it from the ranking.
+    """
+
+    def __init__(self, max_age):
+        self._lock = Lock()
+        self._entries = []
+        # host: (value, time of the update)
+        self._values = {}
+        self._max_age = max_age
+
+    def update(self, host, value, now):
+        with self._lock:
+            old = self._values.get(host)
+            if old is not None:
+                del self._entries[bisect.bisect_left(self._entries, (old[0], host))]
+            self._values[host] = (value, now)
+            bisect.insort(self._entries, (value, host))
+
+    def top(self, n, now):
+        """Returns [(host, value)] of the n highest values, highest first"""
+        oldest = now - self._max_age
+        top = []
+        with self._lock:
+            entries = self._entries
+            i = len(entries)
+            while i > 0 and len(top) < n:
+                i -= 1
+                (value, host) = entries[i]
+                if self._values[host][1] < oldest:
+                    # near the end of the list, so cheap to delete
+                    del entries[i]
+                    del self._values[host]
+                else:
+                    top.append((host, value))
+        return top
+
+
+class Subscriber(object):
+    """The changes a /o/stream client has yet to be sent
+
+    Changes are coalesced by key, only the latest fragment of an entry
+    waits, so a slow client costs at most one fragment per entry it
+    follows.  Past max_pending entries the pending changes are dropped
+    and the client is told to resync from /o/view instead.
+    """
+
+    def __init__(self, host=None, service=None, max_pending=10000):
+        self._host = host
+        self._service = service
+        self._max_pending = max_pending
+        self._lock = Lock()
+        self._ready = Event()
+        self._pending = {}
+        self._overflowed = False
+
+    def offer(self, fragments):
+        with self._lock:
+            for (key_tup, fragment) in fragments:
+                if ((self._host is None or key_tup[0] == self._host) and
+                    (self._service is None or key_tup[1] == self._service)):
+                    self._pending[key_tup] = fragment
+            if len(self._pending) > self._max_pending:
+                self._pending = {}
+                self._overflowed = True
+            if self._pending or self._overflowed:
+                self._ready.set()
+
+    def take(self, timeout):
+        """Waits for changes, returns (overflowed, fragments)"""
+        self._ready.wait(timeout)
+        with self._lock:
+            self._ready.clear()
+            changes = (self._overflowed, self._pending.values())
+            self._pending = {}
+            self._overflowed = False
+        return changes
+
+
+class Stripe(object):
+    """The entries of the hosts hashing to one stripe of a Storage
+
+    `entries` is a (kv, fragments) pair of dicts which writers set in
+    place under the lock, so a write costs the same however many entries
+    there are.  Setting a key of a dict is atomic, readers take single
+    entries without the lock and copy a whole dict, with one call like
+    items(), instead of iterating it.  Only the Series, updated in place,
+    are read under the lock.
+
+    `restored` holds the (hosts, services, fragments) columns restored
+    from the journal and not merged into the fragments yet, see
+    Storage.restore.
+    """
 
     def __init__(self):
-        self._kv = {}
+        self.lock = Lock()
+        self.entries = ({}, {})
+        self.series = {}
+        self.restored = []
+
+
+class Storage(object):
+    """Latest data per (host, service).
+
+    Every entry is also kept JSON encoded, as its '"host|service": {...}'
+    member of the view, re-encoded only when the entry is set.  The view
+    itself is joined from those fragments at most once per version.
+
+    The entries are striped by host, so concurrent ingest only contends
+    for the stripes it writes and readers never wait for it, see Stripe.
+    """
+    STRIPES = 64
+    # metrics every service is ranked by, see top()
+    RANKED = ('read_bytes', 'write_bytes', 'cpu_usage', 'rss')
+    # every subscriber holds a server thread for as long as it streams,
+    # web.py's own server has 10 of them; see o_stream
+    MAX_SUBSCRIBERS = 4
+    # seconds without a report after which a host leaves the rankings,
+    # three of the monitor's default intervals
+    RANK_MAX_AGE = 180
+
+    def __init__(self, stripes=STRIPES, max_subscribers=MAX_SUBSCRIBERS,
+                 rank_max_age=RANK_MAX_AGE, series_tiers=Series.TIERS):
+        self._stripes = [Stripe() for i in xrange(stripes)]
+        self._max_subscribers = max_subscribers
+        self._rank_max_age = rank_max_age
+        self._series_tiers = series_tiers
+        # replaced, never changed, so set_many walks it without the lock
+        self._subscribers = ()
+        self._subscribers_lock = Lock()
+        self._rankings = {}
+        self._rankings_lock = Lock()
+        self._journal = None
+        self._version = 0
+        self._version_lock = Lock()
+        # tells apart the versions of different gateway runs in ETags
+        self._epoch = int(time.time())
+        self._view = (None, None)
+
+    def _stripe(self, key_tup):
+        return self._stripes[hash(key_tup[0]) % len(self._stripes)]
+
+    def _entries(self, stripe):
+        """Returns stripe.entries, with what was restored merged in"""
+        if stripe.restored:
+            with stripe.lock:
+                self._merge_restored(stripe)
+        return stripe.entries
 
-    def set(self, key_tup, val=None):
-        self._kv[key_tup] = val
+    def _merge_restored(self, stripe):
+        # under the lock; what was set since is newer than anything restored
+        if not stripe.restored:
+            return
+        (kv, fragments) = stripe.entries
+        merged = {}
+        for (hosts, services, restored) in stripe.restored:
+            merged.update(itertools.izip(itertools.izip(hosts, services), restored))
+        merged.update(fragments)
+        # published before restored is emptied, see _entries
+        stripe.entries = (kv, merged)
+        stripe.restored = []
+
+    def _bump_version(self):
+        with self._version_lock:
+            self._version += 1
+
+    def set(self, key_tup, val=None, timestamp=None):
+        self.set_many([(key_tup, val, timestamp)])
+
+    def set_many(self, items):
+        """Set a batch of (key_tup, val, timestamp), as one version"""
+        now = time.time()
+        fragments = []
+        by_stripe = {}
+        for (key_tup, val, timestamp) in items:
+            # encoded before any lock is taken
+            fragment = '%s: %s' % (json.dumps('%s|%s' % key_tup), json.dumps(val))
+            fragments.append((key_tup, fragment))
+            by_stripe.setdefault(self._stripe(key_tup), []).append(
+                (key_tup, val, now if timestamp is None else timestamp, fragment))
+        for (stripe, stripe_items) in by_stripe.iteritems():
+            with stripe.lock:
+                self._merge_restored(stripe)
+                (kv, stripe_fragments) = stripe.entries
+                for (key_tup, val, timestamp, fragment) in stripe_items:
+                    kv[key_tup] = val
+                    stripe_fragments[key_tup] = fragment
+                    series = stripe.series.get(key_tup)
+                    if series is None:
+                        if not Series.wants(val):
+                            # the monitor's _self e.g., nothing to keep
+                            continue
+                        series = stripe.series[key_tup] = Series(self._series_tiers)
+                    series.add(timestamp, val)
+        for (key_tup, val, timestamp) in items:
+            self._rank(key_tup, val, now)
+        for subscriber in self._subscribers:
+            subscriber.offer(fragments)
+        if self._journal:
+            # a record per stripe, see restore
+            for stripe_items in by_stripe.itervalues():
+                self._journal.append([(key_tup, fragment) for (key_tup, val, timestamp, fragment)
+                                      in stripe_items])
+        self._bump_version()
+
+    def _rank(self, key_tup, val, now):
+        (host, service) = key_tup
+        for metric in self.RANKED:
+            value = val.get(metric)
+            if value is None:
+                continue
+            ranking = self._rankings.get((service, metric))
+            if ranking is None:
+                with self._rankings_lock:
+                    ranking = self._rankings.setdefault((service, metric),
+                                                        Ranking(self._rank_max_age))
+            ranking.update(host, value, now)
+
+    def top(self, service, metric, n):
+        """Returns [(host, value)] of the n hosts with the highest metric
+
+        Entries restored from the journal are ranked once their host
+        reports again; hosts which have not reported for rank_max_age
+        seconds are left out.
+        """
+        ranking = self._rankings.get((service, metric))
+        if ranking is None:
+            return []
+        return ranking.top(n, time.time())
+
+    def subscribe(self, host=None, service=None):
+        """Returns a Subscriber to the changes, None if there are too many"""
+        with self._subscribers_lock:
+            if len(self._subscribers) >= self._max_subscribers:
+                return None
+            subscriber = Subscriber(host, service)
+            self._subscribers += (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._subscribers_lock:
+            self._subscribers = tuple(s for s in self._subscribers
+                                      if s is not subscriber)
+
+    def restore(self, hosts, services, fragments):
+        """Set entries loaded from the journal, without history
+
+        Only before serving.  The entries of a batch which all fall in one
+        stripe, as the journal writes them, are kept as the columns they
+        come in: the stripe merges them into its dict the first time it is
+        used, so a restart builds no key per entry before serving.  Their
+        data is decoded from the fragment only once it is asked for.
+        """
+        # hashing the distinct hosts caches their hash for the merge too
+        stripe_indexes = set(itertools.imap(len(self._stripes).__rmod__,
+                                            itertools.imap(hash, set(hosts))))
+        if len(stripe_indexes) == 1:
+            self._stripes[stripe_indexes.pop()].restored.append((hosts, services, fragments))
+        else:
+            # after what was restored before it
+            for stripe in self._stripes:
+                self._merge_restored(stripe)
+            for (key_tup, fragment) in itertools.izip(itertools.izip(hosts, services), fragments):
+                self._stripe(key_tup).entries[1][key_tup] = fragment
+        self._bump_version()
+
+    def fragments(self):
+        """Returns [[(key_tup, fragment)]] of all entries, a list per stripe"""
+        return [self._entries(stripe)[1].items() for stripe in self._stripes]
+
+    def set_journal(self, journal):
+        self._journal = journal
 
     def get(self, key_tup):
-        return self._kv.get(key_tup)
+        stripe = self._stripe(key_tup)
+        (kv, fragments) = self._entries(stripe)
+        val = kv.get(key_tup)
+        if val is None:
+            fragment = fragments.get(key_tup)
+            if fragment is not None:
+                # restored from the journal and not decoded yet
+                val = json.loads('{%s}' % fragment).values()[0]
+                with stripe.lock:
+                    # unless a writer set a newer one meanwhile
+                    kv.setdefault(key_tup, val)
+        return val
+
+    def query_series(self, key_tup, tier, start, end):
+        """Returns Series.query of the entry, None if there is none or it
+        does not keep tier"""
+        stripe = self._stripe(key_tup)
+        with stripe.lock:
+            series = stripe.series.get(key_tup)
+            if series is None:
+                return None
+            return series.query(tier, start, end)
 
     def to_json(self):
         m = {}
-        for k, v in self._kv.iteritems():
-            m['%s|%s' % k] = v
+        for stripe_fragments in self.fragments():
+            for (k, fragment) in stripe_fragments:
+                m['%s|%s' % k] = self.get(k)
         return m
 
-storage = Storage()
+    def etag(self):
+        return '"%x-%x"' % (self._epoch, self._version)
+
+    def view_json(self):
+        """Returns to_json() as rendered by render_json, encoded"""
+        version = self._version
+        (view_version, view) = self._view
+        if view_version != version:
+            # the fragments of a stripe that is written meanwhile may be
+            # newer than version, the next version rebuilds the view anyway
+            fragments = []
+            for stripe in self._stripes:
+                fragments.extend(self._entries(stripe)[1].values())
+            view = '{"_code": 0, "data": {%s}}' % ', '.join(fragments)
+            self._view = (version, view)
+        return view
+
+
+class Journal(object):
+    """Write-ahead log and snapshot of a Storage, to restart with its data.
+
+    Both files are sequences of records: length and crc32 of the payload,
+    then the payload, a marshal of the columns of a batch of entries of
+    one stripe: the distinct hosts NUL separated and the index of each
+    entry's host as an array, the same for the services, and the tuple
+    of fragments.  Only the encoded fragment is kept, so a restore
+    creates one string per entry and parses no JSON; Storage merges the
+    columns into a stripe when it is first used and decodes the data of
+    an entry when it is asked for.
+
+    append() only queues the record; a writer thread writes and fsyncs
+    what has queued up every commit_interval seconds, so ingest never
+    waits for the disk and a crash loses at most that interval.  Once the
+    log outgrows compact_bytes the current entries are written to a new
+    snapshot and the log starts over.  History (the Series rings) is not
+    journaled, only the latest data of each key.
+    """
+    _header = struct.Struct('<II')
+    # entries per snapshot record
+    CHUNK = 4096
+
+    def __init__(self, directory, commit_interval=0.2, compact_bytes=64 << 20):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._snapshot_path = os.path.join(directory, 'snapshot')
+        self._log_path = os.path.join(directory, 'log')
+        self._commit_interval = commit_interval
+        self._compact_bytes = compact_bytes
+        self._pending = []
+        self._lock = Lock()
+        self._log = None
+        self._storage = None
+        self._stop = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.setDaemon(True)
+
+    @staticmethod
+    def _names(values):
+        """Returns (the distinct values NUL joined, their index per value)"""
+        index = {}
+        indexes = array('I', [index.setdefault(value, len(index)) for value in values])
+        names = sorted(index, key=index.get)
+        return (u'\0'.join(names).encode('utf-8'), indexes.tostring())
+
+    @staticmethod
+    def _values(names, indexes):
+        return map(names.decode('utf-8').split(u'\0').__getitem__, array('I', indexes))
+
+    def _encode(self, fragments):
+        (keys, fragments) = zip(*fragments)
+        (hosts, services) = zip(*keys)
+        payload = marshal.dumps(self._names(hosts) + self._names(services) + (fragments,))
+        return self._header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def _replay(self, path, storage):
+        """Restores the records of path, returns the length of its valid prefix"""
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return 0
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return 0
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            header = self._header
+            restore = storage.restore
+            while offset + header.size <= size:
+                (length, crc) = header.unpack_from(buf, offset)
+                start = offset + header.size
+                # a buffer, not a copy of the payload
+                payload = buffer(buf, start, length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    # torn by a crash while it was being written
+                    break
+                (hosts, host_indexes, services, service_indexes, fragments) = marshal.loads(payload)
+                restore(self._values(hosts, host_indexes),
+                        self._values(services, service_indexes), fragments)
+                offset = start + length
+            return offset
+        finally:
+            buf.close()
+
+    def load(self, storage):
+        """Restores the snapshot and the log into storage, then journals its sets"""
+        # nothing restored is cyclic, but the millions of new objects
+        # would trigger collections over an ever larger heap
+        gc.disable()
+        try:
+            self._replay(self._snapshot_path, storage)
+            valid = self._replay(self._log_path, storage)
+        finally:
+            gc.enable()
+        self._log = open(self._log_path, 'ab')
+        # drop a torn tail, appends go after the last complete record
+        self._log.truncate(valid)
+        self._storage = storage
+        storage.set_journal(self)
+
+    def start(self):
+        self._thread.start()
+
+    def append(self, fragments):
+        """Journal [(key_tup, fragment)] set in one batch"""
+        if not fragments:
+            return
+        record = self._encode(fragments)
+        with self._lock:
+            self._pending.append(record)
+
+    def _commit(self):
+        with self._lock:
+            (pending, self._pending) = (self._pending, [])
+        if pending:
+            self._log.write(''.join(pending))
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def _compact(self):
+        # whatever is set from here on is either in the snapshot or still
+        # pending for the new log; replaying it twice is harmless
+        tmp_path = self._snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            # records never span two stripes, see Storage.restore
+            for fragments in self._storage.fragments():
+                # a host's entries together, its name is written once
+                fragments.sort()
+                for i in xrange(0, len(fragments), self.CHUNK):
+                    f.write(self._encode(fragments[i:i + self.CHUNK]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._snapshot_path)
+        self._log.truncate(0)
+
+    def _run(self):
+        while not self._stop.wait(self._commit_interval):
+            try:
+                self._commit()
+                if os.fstat(self._log.fileno()).st_size > self._compact_bytes:
+                    self._compact()
+            except Exception, e:
+                print e
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._commit()
+        self._log.close()
+
+
+# GATEWAY_MAX_STREAMS must stay well below the server's thread count
+storage = Storage(max_subscribers=int(os.environ.get('GATEWAY_MAX_STREAMS',
+                                                     Storage.MAX_SUBSCRIBERS)),
+                  rank_max_age=float(os.environ.get('GATEWAY_RANK_MAX_AGE',
+                                                    Storage.RANK_MAX_AGE)),
+                  # the slots of the history tiers, "raw=360,1m=0" e.g.
+                  series_tiers=series_tiers(os.environ.get('GATEWAY_SERIES_SLOTS', '')))
+if os.environ.get('GATEWAY_DATA_DIR'):
+    # persist the latest data of every key across restarts
+    journal = Journal(os.environ['GATEWAY_DATA_DIR'])
+    journal.load(storage)
+    journal.start()
 
 
 def render_json(data):
@@ -41,20 +676,177 @@ def render_json(data):
     return data
 
 
+def request_body():
+    data = web.data()
+    if web.ctx.env.get('HTTP_CONTENT_ENCODING') == 'gzip':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return data
+
+
+def iter_body_chunks(chunk_size=64 << 10):
+    """Yields the request body in pieces of at most chunk_size bytes while
+    it is being read
+
+    A gzipped body is inflated a piece at a time as well, so a small
+    compressed body inflating to a huge one is never held whole.
+    """
+    env = web.ctx.env
+    stream = env['wsgi.input']
+    # None until EOF, a chunked upload has no length
+    remaining = env.get('CONTENT_LENGTH')
+    remaining = int(remaining) if remaining else None
+    decompressor = None
+    if env.get('HTTP_CONTENT_ENCODING') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while remaining is None or remaining > 0:
+        chunk = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        if not decompressor:
+            yield chunk
+            continue
+        while True:
+            inflated = decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+            if inflated:
+                yield inflated
+            # a full piece may leave more output than input behind
+            if not chunk and len(inflated) < chunk_size:
+                break
+    if decompressor:
+        yield decompressor.flush()
+
+
+def iter_body_lines(chunk_size=64 << 10, max_line=1 << 20):
+    """Yields the lines of the request body while it is being read
+
+    The body is never held as a whole, see iter_body_chunks.  A line
+    longer than max_line is not held either, it is yielded as None.
+    """
+    pending = ''
+    overlong = False
+    for chunk in iter_body_chunks(chunk_size):
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            if overlong:
+                # the end of the line that was too long
+                overlong = False
+                line = None
+            yield line
+        if len(pending) > max_line:
+            overlong = True
+            pending = ''
+    yield None if overlong else pending
+
+
+def report_items(js):
+    """Returns the (key_tup, data, timestamp) entries of a report
+
+    The 'threads' list of an entry, its hottest threads, is stored in
+    its data.  Raises ValueError unless all of them can be stored: a
+    report is taken whole or not at all.
+    """
+    timestamp = js.get('time')
+    if timestamp is not None and not isinstance(timestamp, (int, long, float)):
+        raise ValueError('time is not a number')
+    items = []
+    for l in js['list']:
+        (host, service, data) = (js['host'], l['service'], l['data'])
+        if not (isinstance(host, basestring) and isinstance(service, basestring)
+                and isinstance(data, dict)):
+            raise ValueError('not a report entry')
+        for field in Series.FIELDS:
+            value = data.get(field)
+            if value is not None and not isinstance(value, (int, long, float)):
+                raise ValueError('%s is not a number' % field)
+        threads = l.get('threads')
+        if threads is not None:
+            if not isinstance(threads, list):
+                raise ValueError('threads is not a list')
+            data = dict(data, threads=threads)
+        items.append(((host, service), data, timestamp))
+    return items
+
+
+# decode() keeps per host state, one request at a time
+wire_decoder = wire.Decoder()
+wire_lock = Lock()
+
+
 class i_update:
     def POST(self):
-        wi = web.input()
-        js = json.loads(wi.get('json'))
-        for l in js['list']:
-            storage.set((js['host'], l['service']), l['data'])
+        content_type = web.ctx.env.get('CONTENT_TYPE', '')
+        items = []
+        try:
+            if content_type.startswith(wire.CONTENT_TYPE):
+                try:
+                    with wire_lock:
+                        docs = wire_decoder.decode(request_body())
+                except wire.ResyncError:
+                    # the sender starts over with a keyframe
+                    raise web.HTTPError('409 Conflict')
+            elif content_type.startswith('application/json'):
+                # a batch of reports in the body, maybe gzipped
+                docs = json.loads(request_body())
+                if isinstance(docs, dict):
+                    docs = [docs]
+            else:
+                docs = [json.loads(web.input().get('json'))]
+            for js in docs:
+                # time is when the report was sampled, it may come late
+                # from a spool
+                items.extend(report_items(js))
+        except (ValueError, KeyError, TypeError, AttributeError, IndexError,
+                struct.error, zlib.error):
+            # malformed, sending it again would not help
+            raise web.badrequest()
+        storage.set_many(items)
         return render_json('ok')
 
 
+class i_bulk:
+    """Many reports in one request, as NDJSON: one report per line
+
+    Lines are parsed as they arrive and stored in batches of BATCH
+    entries.  A line which is not a valid report is counted and skipped.
+    """
+    BATCH = 1000
+
+    def POST(self):
+        batch = []
+        entries = 0
+        errors = 0
+        for line in iter_body_lines():
+            if line is None:
+                # too long to be a report
+                errors += 1
+                continue
+            if not line.strip():
+                continue
+            try:
+                batch.extend(report_items(json.loads(line)))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                errors += 1
+                continue
+            if len(batch) >= self.BATCH:
+                storage.set_many(batch)
+                entries += len(batch)
+                batch = []
+        if batch:
+            storage.set_many(batch)
+            entries += len(batch)
+        return render_json({'entries': entries, 'errors': errors})
+
+
 class o_info:
     def GET(self):
         wi = web.input()
         key = (wi.get('h'), wi.get('s'))
-        data = storage.get(key)
+        # a copy, the stored data is shared with the cached view
+        data = dict(storage.get(key))
         data.update({
             'mem': 0,
             'cpu': 0,
@@ -69,7 +861,75 @@ class o_info:
 
 class o_view:
     def GET(self):
-        return render_json(storage.to_json())
+        etag = storage.etag()
+        web.header('ETag', etag)
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+            raise web.notmodified()
+        web.header('Content-Type','application/json; charset=utf-8')
+        return storage.view_json()
+
+
+class o_series:
+    def GET(self):
+        wi = web.input()
+        tier = wi.get('tier', 'raw')
+        if tier not in dict((t[0], t) for t in Series.TIERS):
+            raise web.badrequest()
+        start = float(wi.get('from', 0))
+        end = float(wi.get('to', 'inf'))
+        series = storage.query_series((wi.get('h'), wi.get('s')), tier, start, end)
+        if series is None:
+            raise web.notfound()
+        return render_json(series)
+
+
+class o_top:
+    def GET(self):
+        wi = web.input()
+        metric = wi.get('m')
+        if metric not in Storage.RANKED:
+            raise web.badrequest()
+        top = storage.top(wi.get('s'), metric, int(wi.get('n', 10)))
+        return render_json([{'host': host, 'value': value} for (host, value) in top])
+
+
+class o_stream:
+    """Server-sent events of the entries as they change
+
+    An 'update' event holds the changed entries like /o/view's data, a
+    'resync' event means changes were dropped and /o/view has to be
+    fetched again.
+
+    Each stream holds one server thread until the client goes away, so
+    at most GATEWAY_MAX_STREAMS (default Storage.MAX_SUBSCRIBERS, 4) are
+    served at once and further ones get 503.  Keep it well below the
+    server's thread count (10 for web.py's own server), or streams
+    starve /i/update.
+    """
+    KEEPALIVE = 15
+
+    def GET(self):
+        wi = web.input()
+        subscriber = storage.subscribe(wi.get('h'), wi.get('s'))
+        if subscriber is None:
+            raise web.HTTPError('503 Service Unavailable')
+        web.header('Content-Type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+        return self._events(subscriber)
+
+    def _events(self, subscriber):
+        try:
+            while True:
+                (overflowed, fragments) = subscriber.take(self.KEEPALIVE)
+                if overflowed:
+                    yield 'event: resync\ndata: {}\n\n'
+                elif fragments:
+                    yield 'event: update\ndata: {%s}\n\n' % ', '.join(fragments)
+                else:
+                    yield ': keepalive\n\n'
+        finally:
+            # also when the client went away and the server closes us
+            storage.unsubscribe(subscriber)
 
 
 wsgi_app = app.wsgifunc()
@@ -0,0 +1,97 @@
+import io
+import os
+
+from clock import monotonic
+from taskstats import Stats
+
+
+class CgroupCounter(object):
+    """Resource usage of a service from its cgroup (v2) instead of its threads.
+
+    Every number comes from one read of a file the kernel keeps for the
+    whole group, so a round costs the same whatever the number of
+    processes and threads in it:
+
+        cpu.stat        usage_usec, for cpu_usage
+        memory.current  for rss
+        io.stat         rbytes and wbytes summed over the devices
+        pids.current    the tasks (threads) in the group, for num_threads
+        cgroup.procs    the processes, for num_processes
+
+    The counts of child cgroups are included, except in cgroup.procs which
+    only lists the group's own processes.  A file of a controller that is
+    not enabled for the group reads as 0, as do vm (a cgroup has no
+    virtual size) and the taskstats only fields of the delta.
+
+    Files are kept open and re-read from offset 0.  When the cgroup is
+    removed the reads fail and IOError is raised.
+    """
+    _files = ('cpu.stat', 'memory.current', 'io.stat', 'pids.current',
+              'cgroup.procs')
+
+    def __init__(self, path, root='/sys/fs/cgroup'):
+        # an absolute path is taken as is
+        self.path = os.path.join(root, path)
+        if not os.path.isdir(self.path):
+            raise IOError('no cgroup at %s' % self.path)
+        self._f = {}
+        for name in self._files:
+            try:
+                self._f[name] = io.FileIO(os.path.join(self.path, name))
+            except IOError:
+                # controller not enabled
+                pass
+        (self._usage, self._read_bytes, self._write_bytes) = self._totals()
+        self._timestamp = monotonic()
+
+    def update(self):
+        """Returns (cpu_usage, num_threads, vm, rss, delta, duration,
+        num_processes), as ProcessCounter.update_tasks_stats does plus the
+        process count"""
+        (usage, read_bytes, write_bytes) = self._totals()
+        rss = self._int('memory.current')
+        num_threads = self._int('pids.current')
+        procs = self._read('cgroup.procs')
+        num_processes = procs.count('\n') if procs else 0
+        t = monotonic()
+        duration = t - self._timestamp
+        self._timestamp = t
+        delta = Stats.build_all_zero()
+        delta.read_bytes = read_bytes - self._read_bytes
+        delta.write_bytes = write_bytes - self._write_bytes
+        cpu_usage = (usage - self._usage) * 1e-6 / duration
+        (self._usage, self._read_bytes, self._write_bytes) = (usage, read_bytes, write_bytes)
+        return (cpu_usage, num_threads, 0, rss, delta, int(duration), num_processes)
+
+    def close(self):
+        for f in self._f.values():
+            f.close()
+        self._f = {}
+
+    def _totals(self):
+        usage = 0
+        for line in self._read('cpu.stat').splitlines():
+            if line.startswith('usage_usec '):
+                usage = int(line[11:])
+                break
+        read_bytes = write_bytes = 0
+        for line in self._read('io.stat').splitlines():
+            # "8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=5 dios=6"
+            for field in line.split(' ')[1:]:
+                if field.startswith('rbytes='):
+                    read_bytes += int(field[7:])
+                elif field.startswith('wbytes='):
+                    write_bytes += int(field[7:])
+        return (usage, read_bytes, write_bytes)
+
+    def _int(self, name):
+        value = self._read(name)
+        return int(value) if value else 0
+
+    def _read(self, name):
+        f = self._f.get(name)
+        if f is None:
+            return ''
+        f.seek(0)
+        # small files, but cgroup.procs and io.stat grow with the group
+        return f.read()
@@ -0,0 +1,26 @@
+import os
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # python 2, call clock_gettime(CLOCK_MONOTONIC) through ctypes
+    import ctypes
+
+    CLOCK_MONOTONIC = 1
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long),
+                    ("tv_nsec", ctypes.c_long)]
+
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _clock_gettime = _libc.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        """Seconds from an arbitrary point, unaffected by clock changes"""
+        t = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
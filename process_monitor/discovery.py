@@ -0,0 +1,75 @@
+import os
+
+
+class ProcessDiscovery(object):
+    """Find the processes whose command line contains one of the names.
+
+    Scans /proc directly instead of forking `ps -ef`.  The result of
+    matching a process is cached by (pid, starttime), so a pass only reads
+    the stat line of known processes and the cmdline of new ones, and a
+    recycled pid is matched again.  The comm is kept along with the
+    starttime so that a process which exec'd is matched again too.
+    """
+    def __init__(self, process_names, root='/proc'):
+        self._process_names = process_names
+        self._root = root
+        self._classified = {}
+
+    def discover(self):
+        """Returns {pid: name} for the matching processes"""
+        classified = {}
+        matched = {}
+        for entry in os.listdir(self._root):
+            if not entry.isdigit():
+                continue
+            pid = int(entry)
+            identity = self._identity(pid)
+            if identity is None:
+                # exited while we were scanning
+                continue
+            cached = self._classified.get(pid)
+            if cached and cached[0] == identity:
+                name = cached[1]
+            else:
+                name = self._classify(pid)
+            classified[pid] = (identity, name)
+            if name:
+                matched[pid] = name
+        self._classified = classified
+        return matched
+
+    def match(self, pid):
+        """Match a single process, e.g. one that just forked or exec'd"""
+        identity = self._identity(pid)
+        if identity is None:
+            self._classified.pop(pid, None)
+            return None
+        name = self._classify(pid)
+        self._classified[pid] = (identity, name)
+        return name
+
+    def forget(self, pid):
+        self._classified.pop(pid, None)
+
+    def _identity(self, pid):
+        """Returns (starttime, comm) of pid"""
+        try:
+            with open('%s/%d/stat' % (self._root, pid)) as f:
+                stat = f.read()
+        except IOError:
+            return None
+        # comm may contain spaces and parentheses, the fields after it don't
+        comm_end = stat.rindex(')')
+        starttime = stat[comm_end + 2:].split(' ', 20)[19]
+        return (starttime, stat[stat.index('(') + 1:comm_end])
+
+    def _classify(self, pid):
+        try:
+            with open('%s/%d/cmdline' % (self._root, pid)) as f:
+                cmdline = f.read().replace('\0', ' ')
+        except IOError:
+            return None
+        for name in self._process_names:
+            if cmdline.find(name) != -1:
+                return name
+        return None
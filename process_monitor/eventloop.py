@@ -0,0 +1,82 @@
+import errno
+import heapq
+import select
+
+from clock import monotonic
+
+
+class EventLoop(object):
+    """A small single threaded epoll reactor: fd readers and timers.
+
+    Covers what the monitor needs of asyncio, which Python 2 lacks.
+    Callbacks run on the loop thread and must not block; whatever does
+    (HTTP reporting) stays on its own thread and is fed through a queue.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._readers = {}
+        self._timers = []
+        self._timer_seq = 0
+        self._running = False
+
+    def time(self):
+        return monotonic()
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None):
+            self._epoll.unregister(fd)
+
+    def call_at(self, when, callback):
+        # the sequence number keeps equal deadlines in order and
+        # callbacks out of the comparison
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (when, self._timer_seq, callback))
+
+    def call_later(self, delay, callback):
+        self.call_at(self.time() + delay, callback)
+
+    def call_every(self, interval, callback, phase=0):
+        """Call callback on the fixed deadlines start + phase + k * interval
+
+        The next deadline follows from the previous one, not from when
+        the callback returned, so the period does not drift.  Deadlines
+        missed while the loop was busy are skipped, not caught up.
+        """
+        def fire(when):
+            callback()
+            deadline = when + interval
+            now = self.time()
+            if deadline <= now:
+                deadline += ((now - deadline) // interval + 1) * interval
+            self.call_at(deadline, lambda: fire(deadline))
+
+        start = self.time() + phase
+        self.call_at(start, lambda: fire(start))
+
+    def stop(self):
+        self._running = False
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            timeout = -1
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - self.time())
+            try:
+                events = self._epoll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                callback = self._readers.get(fd)
+                if callback:
+                    callback()
+            now = self.time()
+            while self._timers and self._timers[0][0] <= now:
+                when, seq, callback = heapq.heappop(self._timers)
+                callback()
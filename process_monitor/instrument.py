@@ -0,0 +1,84 @@
+from array import array
+from threading import Lock
+
+from clock import monotonic
+
+
+class Histogram(object):
+    """Latencies in power of two buckets of microseconds
+
+    Recording is an increment; percentiles are the upper bound of the
+    bucket they fall in, so they are exact to a factor of two.
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self._counts = array('L', [0]) * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)
+        self._counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Returns the p-th percentile in seconds"""
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (bucket, n) in enumerate(self._counts):
+            seen += n
+            if seen >= rank:
+                return min((1 << bucket) * 1e-6, self.max)
+        return self.max
+
+    def summary(self, prefix):
+        """Returns the flat {name: number} summary, times in milliseconds"""
+        return {
+            prefix + '_count': self.count,
+            prefix + '_avg_ms': self.total / self.count * 1e3 if self.count else 0.0,
+            prefix + '_p50_ms': self.percentile(50) * 1e3,
+            prefix + '_p99_ms': self.percentile(99) * 1e3,
+            prefix + '_max_ms': self.max * 1e3,
+        }
+
+
+class Instruments(object):
+    """Per phase latency histograms of the monitor itself
+
+    Shared by the loop and the reporter thread.  snapshot() returns the
+    numbers gathered since the previous snapshot as one flat dict, so
+    they fit a report's data like any service's.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+
+    def start(self):
+        return monotonic()
+
+    def finish(self, phase, started):
+        """Record the time since start() as one occurrence of phase"""
+        elapsed = monotonic() - started
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = Histogram()
+            histogram.record(elapsed)
+
+    def snapshot(self, reset=True):
+        data = {}
+        with self._lock:
+            histograms = self._histograms
+            if reset:
+                self._histograms = {}
+            for (phase, histogram) in histograms.items():
+                data.update(histogram.summary(phase))
+        return data
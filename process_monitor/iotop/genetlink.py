@@ -37,8 +37,11 @@ class GenlHdr:
         return struct.pack("BBxx", self.cmd, self.version)
 
 
+_genl_hdr = struct.Struct("BBxx")
+
+
 def _genl_hdr_parse(data):
-    return GenlHdr(*struct.unpack("BBxx", data))
+    return GenlHdr(*_genl_hdr.unpack_from(data))
 
 GENL_ID_CTRL = NLMSG_MIN_TYPE
 
@@ -55,11 +58,12 @@ class GeNlMessage(Message):
     def recv(conn):
         msg = conn.recv()
         packet = msg.payload
-        hdr = _genl_hdr_parse(packet[:4])
+        hdr = _genl_hdr_parse(packet)
 
         genlmsg = GeNlMessage(msg.type, hdr.cmd, [], msg.flags)
-        genlmsg.attrs = parse_attributes(packet[4:])
+        genlmsg.attrs = parse_attributes(packet, 4)
         genlmsg.version = hdr.version
+        genlmsg.seq = msg.seq
 
         return genlmsg
 
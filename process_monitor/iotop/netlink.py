@@ -138,6 +138,56 @@ class Attr:
         return parse_attributes(self.data)
 
 
+class AttrView(object):
+    """A parsed attribute referring into the received buffer
+
+    The payload is only copied out when `data` is asked for; integer
+    accessors and nested lookups read the shared buffer in place.
+    """
+    __slots__ = ('type', 'buf', 'offset', 'length')
+
+    def __init__(self, attr_type, buf, offset, length):
+        self.type = attr_type
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return '<AttrView type %d, data "%s">' % (self.type, repr(self.data))
+
+    @property
+    def data(self):
+        data = self.buf[self.offset:self.offset + self.length]
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return data
+
+    def u16(self):
+        return struct.unpack_from('H', self.buf, self.offset)[0]
+
+    def s16(self):
+        return struct.unpack_from('h', self.buf, self.offset)[0]
+
+    def u32(self):
+        return struct.unpack_from('I', self.buf, self.offset)[0]
+
+    def s32(self):
+        return struct.unpack_from('i', self.buf, self.offset)[0]
+
+    def str(self):
+        return self.data
+
+    def nulstr(self):
+        return self.data.split('\0')[0]
+
+    def nested(self):
+        return parse_attributes(self.buf, self.offset,
+                                self.offset + self.length)
+
+
 class StrAttr(Attr):
     def __init__(self, attr_type, data):
         Attr.__init__(self, attr_type, "%ds" % len(data), data.encode('utf-8'))
@@ -207,7 +257,7 @@ class Message:
         else:
             self.payload = payload
 
-    def send(self, conn):
+    def _dump(self, conn):
         if self.seq == -1:
             self.seq = conn.seq()
 
@@ -216,7 +266,10 @@ class Message:
 
         hdr = struct.pack("IHHII", length + 4 * 4, self.type,
                           self.flags, self.seq, self.pid)
-        conn.send(hdr + self.payload)
+        return hdr + self.payload
+
+    def send(self, conn):
+        conn.send(self._dump(conn))
 
     def __repr__(self):
         return '<netlink.Message type=%d, pid=%d, seq=%d, flags=0x%x "%s">' % (
@@ -244,14 +297,15 @@ class Connection:
         #      len(contents) vs. msglen for TRUNC
         msglen, msg_type, flags, seq, pid = struct.unpack("IHHII",
                                                           contents[:16])
-        msg = Message(msg_type, flags, seq, contents[16:])
+        msg = Message(msg_type, flags, seq, memoryview(contents)[16:])
         msg.pid = pid
         if msg.type == NLMSG_ERROR:
-            errno = -struct.unpack("i", msg.payload[:4])[0]
+            errno = -struct.unpack_from("i", msg.payload)[0]
             if errno != 0:
                 err = OSError("Netlink error: %s (%d)" % (
                                                     os.strerror(errno), errno))
                 err.errno = errno
+                err.seq = seq
                 raise err
         return msg
 
@@ -260,11 +314,21 @@ class Connection:
         return self._seq
 
 
-def parse_attributes(data):
+_attr_hdr = struct.Struct("HH")
+
+
+def parse_attributes(data, offset=0, end=None):
+    """Parse the attributes in data[offset:end] into AttrView objects
+
+    Walks the buffer by offset instead of re-slicing it, so nothing is
+    copied while parsing.  data can be a string or a memoryview.
+    """
+    if end is None:
+        end = len(data)
     attrs = {}
-    while len(data):
-        attr_len, attr_type = struct.unpack("HH", data[:4])
-        attrs[attr_type] = Attr(attr_type, data[4:attr_len])
-        attr_len = ((attr_len + 4 - 1) & ~3)
-        data = data[attr_len:]
+    unpack_hdr = _attr_hdr.unpack_from
+    while offset < end:
+        attr_len, attr_type = unpack_hdr(data, offset)
+        attrs[attr_type] = AttrView(attr_type, data, offset + 4, attr_len - 4)
+        offset += ((attr_len + 4 - 1) & ~3)
     return attrs
@@ -1,84 +1,278 @@
+import os
+import sys
+import json
+import errno
 import time
+import fcntl
+import signal
 import socket
 import urllib2
-import json
+import itertools
 import requests
 from threading import Thread, Lock
-from Queue import Queue
-from taskstats import ProcessCounter, Stats
-import subprocess
+from collections import deque
+from taskstats import ProcessCounter, TaskStatsTable, TaskExitListener
+from taskstats import TaskStatsShards, TaskStatsBatch
+from discovery import ProcessDiscovery
+from procfs import ProcReader
+from procevents import ProcEvents, PROC_EVENT_NONE, PROC_EVENT_EXIT
+from eventloop import EventLoop
+from reporter import Reporter
+from cgroups import CgroupCounter
+from instrument import Instruments
+import wire
 
 
 class ProcessMonitor(object):
-    def __init__(self, process_names):
+    # with proc events, the /proc scans are only a safety net every few rounds
+    RESCAN_ROUNDS = 10
+    # seconds between samples of a name without its own interval
+    DEFAULT_INTERVAL = 60
+
+    def __init__(self, process_names, proc_events=False, exit_stats=False,
+                 shards=0, intervals=None, gateway='http://192.168.0.189:7001',
+                 spool_dir=None, wire_format=False, proc_io=False,
+                 cgroups=None, top_threads=0):
+        """intervals maps some of the process names to their own sampling
+        interval in seconds, e.g. {'mysqld': 5, 'batch.jar': 300}
+
+        Reports that cannot be delivered to the gateway are kept in
+        spool_dir until it is back, or only in memory without one.
+        wire_format sends them in the compact binary format of wire.py
+        rather than as JSON, for bandwidth: a third of the bytes of
+        gzipped JSON, at about the same CPU (see benchmarks/bench_wire.py).
+
+        proc_io takes the I/O of each process from /proc/<pid>/io rather
+        than from taskstats of every thread, see ProcessCounter; the delay
+        totals are 0 then.  exit_stats and shards work on threads, with
+        either of them proc_io is ignored.
+
+        cgroups maps some of the names to the path of their cgroup (v2),
+        relative to /sys/fs/cgroup, e.g. {'nginx': 'system.slice/nginx.service'};
+        those are accounted from the cgroup's files rather than from their
+        processes, see CgroupCounter.
+
+        top_threads=k adds the k hottest threads of each process by
+        read_bytes, write_bytes and CPU to its service's entry in the
+        report, as 'threads': [{'pid', 'tid', 'comm', 'read_bytes',
+        'write_bytes', 'cpu_usage'}].  They need the taskstats of every
+        thread, so proc_io is ignored with it; the wire format carries the
+        data only and leaves them out."""
         self._process_names = process_names
+        self._cgroups = cgroups or {}
+        self._cgroup_counters = {}
+        self._intervals = intervals or {}
         self._process_ids_counter_m = {}
         self._process_id_name_m = {}
         self._process_name_ids_m = {}
         self._hostname = socket.gethostname()
         self._session = requests.session()
         self._update_lock = Lock()
+        # the monitor's own costs, reported as the _self service
+        self._instruments = Instruments()
+        self._syscalls_reported = {}
+        self._task_table = TaskStatsTable()
+        # forks the workers, so before any thread is started
+        self._shards = TaskStatsShards(shards) if shards else None
+        self._proc_io = proc_io and not (exit_stats or shards or top_threads)
+        self._top_threads = top_threads
+        self._proc_reader = ProcReader()
+        self._batch = TaskStatsBatch()
+        self._discovery = ProcessDiscovery([name for name in process_names
+                                            if name not in self._cgroups])
+        self._rescan = True
+        self._proc_events = None
+        if proc_events:
+            # subscribe before the first scan, so no process slips in between
+            self._proc_events = ProcEvents()
+        self._exit_listener = None
+        if exit_stats:
+            self._exit_listener = TaskExitListener()
+            self._exited_tasks = deque()
+            self._exit_listener_thread = Thread(target=self._exit_listener_worker)
         self._refresh_process_names()
-        self._q = Queue(maxsize=1000)
-        self._reporter = Thread(target=self._report_worker)
-        self._process_name_refresher = Thread(target=self._refresh_process_names_worker)
+        self._reporter = Reporter(gateway + '/i/update', self._session,
+                                  spool_dir=spool_dir,
+                                  encoder=wire.Encoder() if wire_format else None,
+                                  instruments=self._instruments)
+        self._loop = EventLoop()
+        self._rounds = 0
+        # names whose threads are due for a listing despite proc events
+        self._tids_rescan_names = set(process_names)
 
     def _get_process_ids_by_names(self):
-        self._process_id_name_m = {}
+        self._process_id_name_m = self._discovery.discover()
         self._process_name_ids_m = {}
-        p = subprocess.Popen(['ps', '-ef'], stdout=subprocess.PIPE)
-        out, err = p.communicate()
-        for line in out.splitlines():
-            items = line.split()
-            pid = items[1]
-            for name in self._process_names:
-                if line.find(name) != -1:
-                    self._process_id_name_m[pid] = name
-                    if name not in self._process_name_ids_m:
-                        self._process_name_ids_m[name] = []
-                    self._process_name_ids_m[name].append(pid)
-                    continue
+        for (pid, name) in self._process_id_name_m.iteritems():
+            self._process_name_ids_m.setdefault(name, []).append(pid)
 
     def _compute_diff_pid_counter(self):
         counter_pids = set(self._process_ids_counter_m.keys())
         for pid in self._process_id_name_m.keys():
             if pid not in counter_pids:
-                self._process_ids_counter_m[pid] = ProcessCounter(int(pid))
+                try:
+                    self._process_ids_counter_m[pid] = self._new_counter(pid)
+                except IOError:
+                    # exited since discovery saw it
+                    continue
 
         name_ids = set(self._process_id_name_m.keys())
         for pid in counter_pids:
             if pid not in name_ids:
-                del self._process_ids_counter_m[pid]
-
-    def _refresh_process_names_worker(self):
-        while True:
-            self._refresh_process_names()
-            time.sleep(60*10)
+                self._process_ids_counter_m.pop(pid).close()
 
     def _refresh_process_names(self):
+        started = self._instruments.start()
         with self._update_lock:
             self._get_process_ids_by_names()
             self._compute_diff_pid_counter()
+        self._instruments.finish('discover', started)
+
+    def _new_counter(self, pid):
+        return ProcessCounter(pid, self._task_table, self._proc_reader,
+                              self._batch, self._instruments, self._proc_io,
+                              self._top_threads)
+
+    def _add_process(self, pid, name):
+        if pid in self._process_ids_counter_m:
+            return
+        try:
+            self._process_ids_counter_m[pid] = self._new_counter(pid)
+        except IOError:
+            return
+        self._process_id_name_m[pid] = name
+        self._process_name_ids_m.setdefault(name, []).append(pid)
+
+    def _remove_process(self, pid):
+        name = self._process_id_name_m.pop(pid, None)
+        if name:
+            self._process_name_ids_m[name].remove(pid)
+        pcounter = self._process_ids_counter_m.pop(pid, None)
+        if pcounter:
+            pcounter.close()
+
+    def _on_proc_event(self, what, pid, tgid):
+        if what == PROC_EVENT_EXIT:
+            if pid == tgid:
+                self._discovery.forget(pid)
+                self._remove_process(pid)
+            elif tgid in self._process_ids_counter_m:
+                self._process_ids_counter_m[tgid].remove_tid(pid)
+        elif pid != tgid:
+            # a new thread
+            if tgid in self._process_ids_counter_m:
+                self._process_ids_counter_m[tgid].add_tid(pid)
+        else:
+            # a new process, or one that exec'd something else
+            name = self._discovery.match(pid)
+            if name:
+                self._add_process(pid, name)
+            else:
+                self._remove_process(pid)
+
+    def _on_proc_events_readable(self):
+        # runs on the loop, drain what is queued without blocking
+        while True:
+            try:
+                (what, pid, tgid) = self._proc_events.recv()
+            except socket.error as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                # ENOBUFS, events were lost, only a full scan can catch up
+                print e
+                self._rescan = True
+                continue
+            if what == PROC_EVENT_NONE:
+                continue
+            with self._update_lock:
+                self._on_proc_event(what, pid, tgid)
+
+    def _exit_listener_worker(self):
+        # only queue here, so the socket is drained even while a round
+        # holds the update lock
+        while True:
+            (tid, tgid, values) = self._exit_listener.recv()
+            if tgid is None or tgid in self._process_ids_counter_m:
+                self._exited_tasks.append((tid, tgid, values))
+
+    def _counter_of_tid(self, tid):
+        for pcounter in self._process_ids_counter_m.itervalues():
+            if pcounter.has_tid(tid):
+                return pcounter
+        return None
 
-    def _update_processes(self):
+    def _fold_exited_tasks(self):
+        while self._exited_tasks:
+            (tid, tgid, values) = self._exited_tasks.popleft()
+            if tgid is None:
+                pcounter = self._counter_of_tid(tid)
+            else:
+                pcounter = self._process_ids_counter_m.get(tgid)
+            if pcounter:
+                pcounter.task_exited(tid, values)
+
+    def _process_counters(self, names=None):
+        if names is None:
+            return self._process_ids_counter_m.items()
+        return [(pid, self._process_ids_counter_m[pid]) for name in names
+                for pid in self._process_name_ids_m.get(name, ())
+                if pid in self._process_ids_counter_m]
+
+    def _update_processes(self, names=None, rescan_tids=True):
+        if self._exit_listener:
+            self._fold_exited_tasks()
+        process_counters = self._process_counters(names)
+        if self._shards:
+            results = self._update_processes_sharded(process_counters, rescan_tids)
+        else:
+            results = ((pid, self._update_counter(pcounter.update_tasks_stats,
+                                                  rescan_tids))
+                       for (pid, pcounter) in process_counters)
         m = {}
-        for (pid, pcounter) in self._process_ids_counter_m.iteritems():
-            (cpu_usage, num_threads, vm, rss, delta, duration) = pcounter.update_tasks_stats()
+        for (pid, (cpu_usage, num_threads, vm, rss, delta, duration)) in results:
             if delta:
                 m[pid] = {'delta': delta, 'duration':duration, 'vm': vm, 'rss': rss,
                         'cpu_usage': cpu_usage, 'num_threads': int(num_threads)}
+                if self._top_threads:
+                    m[pid]['threads'] = self._process_ids_counter_m[pid].top_threads
         return m
 
+    def _update_processes_sharded(self, process_counters, rescan_tids):
+        # one query for the threads of all processes, split over the shards
+        task_rows_m = {}
+        for (pid, pcounter) in process_counters:
+            task_rows_m[pid] = pcounter.task_rows(rescan_tids)
+        started = self._instruments.start()
+        replied = set(self._shards.query(self._task_table,
+                                         itertools.chain(*task_rows_m.values())))
+        self._instruments.finish('netlink', started)
+        results = []
+        for (pid, pcounter) in process_counters:
+            rows = [row for row in task_rows_m[pid] if row in replied]
+            results.append((pid, self._update_counter(pcounter.account_tasks, rows)))
+        return results
+
+    def _update_counter(self, update, arg):
+        try:
+            return update(arg)
+        except (IOError, OSError) as e:
+            # mostly the process exiting during the round, discovery or
+            # its exit event removes it; the others are still reported
+            if e.errno not in (errno.ENOENT, errno.ESRCH):
+                print e
+            return (None, None, None, None, None, None)
+
     def _trans_id_to_name(self, id_m):
         name_m = {} 
+        threads_m = {}
         for (pid, v) in id_m.iteritems():
             name = self._process_id_name_m.get(pid, None)
             if name:
                 v0 = name_m.get(name, None)
                 if v0:
-                    acc_stats = Stats.build_all_zero()
-                    v['delta'].accumulate(v0['delta'], acc_stats)
-                    name_m[name] = {'delta': acc_stats,
+                    # the per-process deltas are fresh every round, sum in place
+                    v0['delta'].accumulate(v['delta'], v0['delta'])
+                    name_m[name] = {'delta': v0['delta'],
                                     'duration':(int(v0['duration']) + int(v['duration']))/2.0,
                                     'vm':(int(v0['vm']) + int(v['vm'])),
                                     'rss':(int(v0['rss'] + int(v['rss']))),
@@ -95,17 +289,97 @@ class ProcessMonitor(object):
                                     'num_threads': v['num_threads'],
                                     'num_processes': 1,
                                     }
+                if 'threads' in v:
+                    threads_m.setdefault(name, []).extend(
+                        dict(thread, pid=pid) for thread in v['threads'])
+        for (name, threads) in threads_m.iteritems():
+            name_m[name]['threads'] = threads
         return name_m
 
-    def _refresh_processes(self):
+    def _refresh_processes(self, names=None, rescan_tids=True):
         with self._update_lock:
-            id_m = self._update_processes()
+            id_m = self._update_processes(names, rescan_tids)
+            started = self._instruments.start()
             name_m = self._trans_id_to_name(id_m)
-            return name_m
+            self._instruments.finish('aggregate', started)
+        name_m.update(self._update_cgroups(names))
+        return name_m
+
+    def _update_cgroups(self, names=None):
+        name_m = {}
+        for name in (self._cgroups if names is None else names):
+            path = self._cgroups.get(name)
+            if path is None:
+                continue
+            started = self._instruments.start()
+            counter = self._cgroup_counters.get(name)
+            try:
+                if counter is None:
+                    # not there yet, or gone with its service; from the
+                    # next round on once it is back
+                    self._cgroup_counters[name] = CgroupCounter(path)
+                    continue
+                (cpu_usage, num_threads, vm, rss, delta, duration,
+                 num_processes) = counter.update()
+            except IOError:
+                counter = self._cgroup_counters.pop(name, None)
+                if counter:
+                    counter.close()
+                continue
+            finally:
+                self._instruments.finish('cgroup', started)
+            name_m[name] = {'delta': delta, 'duration': duration, 'vm': vm,
+                            'rss': rss, 'cpu_usage': cpu_usage,
+                            'num_threads': num_threads,
+                            'num_processes': num_processes}
+        return name_m
+
+    def self_stats(self, reset=False):
+        """Returns the monitor's own numbers as flat {name: number}
+
+        Phase latencies (*_count, *_avg_ms, *_p50_ms, *_p99_ms, *_max_ms)
+        and syscall counts are since the previous reset, which every
+        _self report does; queue and drop counts are current.
+        """
+        data = self._instruments.snapshot(reset)
+        syscalls = {
+            'netlink_sends': self._batch.sends,
+            'netlink_recvs': self._batch.recvs,
+            'proc_opens': self._proc_reader.opens,
+            'proc_reads': self._proc_reader.reads,
+        }
+        for (name, total) in syscalls.iteritems():
+            data[name] = total - self._syscalls_reported.get(name, 0)
+        if reset:
+            self._syscalls_reported = syscalls
+        data.update(self._reporter.stats())
+        if self._exit_listener:
+            data['exit_events_dropped'] = self._exit_listener.dropped
+        data['processes'] = len(self._process_ids_counter_m)
+        data['tasks'] = len(self._task_table)
+        data['cgroups'] = len(self._cgroup_counters)
+        return data
+
+    def _on_sigusr1(self, signum, frame):
+        # the handler may interrupt the loop inside the instruments' lock,
+        # so it only wakes the loop, which dumps once it is out of it
+        try:
+            os.write(self._sigusr1_pipe[1], 'x')
+        except OSError:
+            # EAGAIN, a dump is pending already
+            pass
+
+    def _dump_self_stats(self):
+        try:
+            os.read(self._sigusr1_pipe[0], 512)
+        except OSError:
+            pass
+        print >>sys.stderr, json.dumps(self.self_stats(), sort_keys=True)
 
     def _report_data(self, d):
         m = {}
         m['host'] = self._hostname
+        m['time'] = int(time.time())
         l = []
         for (k, v) in d.iteritems():
             duration = int(v['duration'])
@@ -123,38 +397,88 @@ class ProcessMonitor(object):
                             'num_processes': v['num_processes'],
                         }
                     })
+            if 'threads' in v:
+                l[-1]['threads'] = v['threads']
 
         if not l:
             return
 
         m['list'] = l
-        js = json.dumps(m) 
-        payload = {'json':js}
-        self._session.post('http://192.168.0.189:7001/i/update', params=payload)
+        # never waits for the gateway, a slow one only fills the queue
+        self._reporter.put(m)
 
-    def _report_worker(self):
-        while True:
-            try:
-                item = self._q.get(block=True)
-                self._report_data(item)
-            except Exception,e:
-                print e
+    def _report_self(self):
+        """Report the _self service, on its own timer so that it covers all
+        the names whatever their intervals, and also when none has data"""
+        self._reporter.put({
+            'host': self._hostname,
+            'time': int(time.time()),
+            'list': [{'service': '_self', 'data': self.self_stats(reset=True)}],
+        })
+
+    def _discover(self):
+        # discovery only inspects new pids, cheap enough for every round;
+        # proc events keep the pids and tids current in between
+        rescan = (not self._proc_events or self._rescan or
+                  self._rounds % self.RESCAN_ROUNDS == 0)
+        self._rescan = False
+        self._rounds += 1
+        if rescan:
+            self._refresh_process_names()
+            self._tids_rescan_names.update(self._process_names)
+
+    def _tick(self, names):
+        rescan_tids = not self._proc_events or bool(self._tids_rescan_names & names)
+        self._tids_rescan_names -= names
+        started = self._instruments.start()
+        name_resources_delta = self._refresh_processes(names, rescan_tids)
+        self._instruments.finish('round', started)
+        self._report_data(name_resources_delta)
+
+    def _schedule(self):
+        """Sample every name on fixed deadlines of its own interval
+
+        The names sharing an interval are spread evenly over it, so their
+        collection work does not pile up at the same instant.
+        """
+        names_by_interval = {}
+        for name in self._process_names:
+            interval = self._intervals.get(name, self.DEFAULT_INTERVAL)
+            names_by_interval.setdefault(interval, []).append(name)
+        # discovery and _self keep up with the most frequently sampled name
+        shortest = min(names_by_interval)
+        self._loop.call_every(shortest, self._discover)
+        # the first _self report after a whole interval
+        self._loop.call_every(shortest, self._report_self, phase=shortest)
+        for (interval, names) in names_by_interval.iteritems():
+            for (i, name) in enumerate(names):
+                self._loop.call_every(interval,
+                                      lambda names=set([name]): self._tick(names),
+                                      phase=interval * i / float(len(names)))
 
     def run(self):
+        # kill -USR1 prints the numbers of the _self service so far
+        self._sigusr1_pipe = os.pipe()
+        for fd in self._sigusr1_pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._loop.add_reader(self._sigusr1_pipe[0], self._dump_self_stats)
+        signal.signal(signal.SIGUSR1, self._on_sigusr1)
+
         #start reporter first
-        self._reporter.setDaemon(True)
         self._reporter.start()
 
-        self._process_name_refresher.setDaemon(True)
-        self._process_name_refresher.start()
+        if self._exit_listener:
+            # its own thread, so exit storms are drained even during a round
+            self._exit_listener_thread.setDaemon(True)
+            self._exit_listener_thread.start()
 
-        while True:
-            name_resources_delta = self._refresh_processes()
-            try:
-                self._q.put_nowait(name_resources_delta)
-            except Full,e:
-                print e
-            time.sleep(60)
+        if self._proc_events:
+            self._proc_events.setblocking(False)
+            self._loop.add_reader(self._proc_events.fileno(),
+                                  self._on_proc_events_readable)
+
+        self._schedule()
+        self._loop.run_forever()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+import socket
+import struct
+
+from iotop.netlink import Connection, Message, NETLINK_CONNECTOR, NLMSG_DONE
+
+#
+# Process events connector, see include/uapi/linux/cn_proc.h
+#
+
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+
+PROC_EVENT_NONE = 0x0
+PROC_EVENT_FORK = 0x1
+PROC_EVENT_EXEC = 0x2
+PROC_EVENT_EXIT = 0x80000000
+
+# struct cn_msg: idx, val, seq, ack, len, flags
+_cn_msg = struct.Struct('IIIIHH')
+# struct proc_event: what, cpu, timestamp_ns
+_proc_event = struct.Struct('IIQ')
+_proc_event_data_offset = _cn_msg.size + _proc_event.size
+
+
+class ProcEvents(object):
+    """Fork, exec and exit notifications from the netlink proc connector.
+
+    Needs CAP_NET_ADMIN.  Events are multicast to every listener, so a
+    listener that does not keep up gets ENOBUFS from recv() and has to
+    resynchronize by scanning /proc.
+    """
+    def __init__(self, rcvbuf=4 << 20):
+        self._connection = Connection(NETLINK_CONNECTOR, groups=CN_IDX_PROC)
+        self._connection.descriptor.setsockopt(socket.SOL_SOCKET,
+                                               socket.SO_RCVBUF, rcvbuf)
+        self._control(PROC_CN_MCAST_LISTEN)
+
+    def _control(self, op):
+        cn_msg = _cn_msg.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, 4, 0)
+        Message(NLMSG_DONE, payload=cn_msg + struct.pack('I', op)).send(self._connection)
+
+    def fileno(self):
+        return self._connection.descriptor.fileno()
+
+    def setblocking(self, flag):
+        """Non-blocking, recv() raises socket.error(EAGAIN) when no event is queued"""
+        self._connection.descriptor.setblocking(flag)
+
+    def close(self):
+        self._control(PROC_CN_MCAST_IGNORE)
+        self._connection.descriptor.close()
+
+    def recv(self):
+        """Wait for the next event, returns (what, pid, tgid)
+
+        For PROC_EVENT_FORK pid and tgid are the child's; a new thread
+        has pid != tgid.  Other events are returned as PROC_EVENT_NONE.
+        """
+        payload = self._connection.recv().payload
+        what = _proc_event.unpack_from(payload, _cn_msg.size)[0]
+        if what == PROC_EVENT_FORK:
+            pid, tgid = struct.unpack_from('8xII', payload, _proc_event_data_offset)
+        elif what in (PROC_EVENT_EXEC, PROC_EVENT_EXIT):
+            pid, tgid = struct.unpack_from('II', payload, _proc_event_data_offset)
+        else:
+            return (PROC_EVENT_NONE, 0, 0)
+        return (what, pid, tgid)
@@ -0,0 +1,71 @@
+import io
+import errno
+
+
+class ProcReader(object):
+    """Reads /proc/<pid>/* files through descriptors kept open.
+
+    A file is opened on its first read and afterwards re-read from offset
+    0 into one reused buffer, so a sample costs a seek and a read instead
+    of open/read/close plus a fresh string.  Once the process is gone the
+    kernel fails the read with ESRCH (also if the pid was recycled, the
+    descriptor still refers to the old process); all descriptors of that
+    pid are then closed and IOError is raised, like open() would.
+
+    Not thread safe, the buffer is shared.
+    """
+    def __init__(self, bufsize=4096, root='/proc'):
+        self.root = root
+        self._files = {}
+        # syscalls so far, for the monitor's own stats
+        self.opens = 0
+        self.reads = 0
+        self._buf = bytearray(bufsize)
+
+    def stat_fields(self, pid, fields):
+        """Returns fields of /proc/<pid>/stat as ints
+
+        Fields are numbered as in proc(5), from 3 (state) on, and only the
+        ones up to the highest requested are split out.  Parsing starts
+        after the last ')', so a comm with spaces or parentheses is fine.
+        """
+        n = self._read(pid, 'stat')
+        start = self._buf.rindex(')', 0, n) + 2
+        values = self._buf[start:n].split(' ', max(fields) - 2)
+        return [int(values[field - 3]) for field in fields]
+
+    def io_fields(self, pid, names):
+        """Returns fields of /proc/<pid>/io as ints, by name"""
+        n = self._read(pid, 'io')
+        values = dict(line.split(': ', 1) for line in str(self._buf[:n]).splitlines())
+        return [int(values[name]) for name in names]
+
+    def evict(self, pid):
+        """Close the descriptors of pid"""
+        for key in [key for key in self._files if key[0] == pid]:
+            self._files.pop(key).close()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def _read(self, pid, name):
+        f = self._files.get((pid, name))
+        if f is None:
+            # IOError(ENOENT) if the process is already gone
+            f = self._files[(pid, name)] = io.FileIO('%s/%d/%s' % (self.root, pid, name))
+            self.opens += 1
+        try:
+            while True:
+                f.seek(0)
+                n = f.readinto(self._buf)
+                self.reads += 1
+                if n < len(self._buf):
+                    return n
+                # might have been truncated, retry with a bigger buffer
+                self._buf = bytearray(len(self._buf) * 2)
+        except IOError as e:
+            if e.errno == errno.ESRCH:
+                self.evict(pid)
+            raise
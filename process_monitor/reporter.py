@@ -0,0 +1,210 @@
+import os
+import json
+import zlib
+from threading import Thread
+from Queue import Queue, Full, Empty
+from collections import deque
+
+import wire
+from clock import monotonic
+from instrument import Instruments
+
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class SegmentQueue(object):
+    """FIFO of request bodies waiting for the gateway, bounded in bytes.
+
+    With a directory every body is one segment file, named by sequence
+    number so they replay in order, also after a restart.  Without one
+    the bodies are only kept in memory.  When the bound is exceeded the
+    oldest segments are dropped and counted in `dropped`.
+    """
+    def __init__(self, directory=None, max_bytes=64 << 20):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segments = deque()
+        self._bytes = 0
+        self._seq = 0
+        self.dropped = 0
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.seg'):
+                    path = os.path.join(directory, name)
+                    self._segments.append((path, os.path.getsize(path)))
+                    self._bytes += os.path.getsize(path)
+                    self._seq = int(name[:-4]) + 1
+
+    def __len__(self):
+        return len(self._segments)
+
+    def append(self, body):
+        if self._directory:
+            path = os.path.join(self._directory, '%020d.seg' % self._seq)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(body)
+            os.rename(path + '.tmp', path)
+            self._segments.append((path, len(body)))
+        else:
+            self._segments.append((body, len(body)))
+        self._seq += 1
+        self._bytes += len(body)
+        while self._bytes > self._max_bytes and len(self._segments) > 1:
+            self.pop()
+            self.dropped += 1
+
+    def peek(self):
+        segment = self._segments[0][0]
+        if not self._directory:
+            return segment
+        with open(segment, 'rb') as f:
+            return f.read()
+
+    def pop(self):
+        (segment, size) = self._segments.popleft()
+        self._bytes -= size
+        if self._directory:
+            os.unlink(segment)
+
+
+class Reporter(object):
+    """Ships report documents to the gateway from a background thread.
+
+    put() only queues.  The sender coalesces whatever has queued up (at
+    most `max_batch` documents) into one request: a JSON list, gzipped,
+    POSTed as the request body.  A request that failed for a while (no
+    connection, a 5xx or 429 answer) is spilled to the SegmentQueue and
+    retried with exponential backoff; while anything is spilled new
+    batches are spilled behind it, so the gateway receives them in order
+    once it is reachable again.  A batch the gateway refuses for good, a
+    4xx answer, is dropped and counted: sending it again would only hold
+    up the ones behind it.
+
+    With a wire.Encoder new batches are sent in the binary format
+    instead; spilled ones are always JSON, as the deltas of the binary
+    format would not survive the spool dropping a batch.
+    """
+    JSON_HEADERS = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    WIRE_HEADERS = {'Content-Type': wire.CONTENT_TYPE}
+
+    def __init__(self, url, session, spool_dir=None, max_spool_bytes=64 << 20,
+                 max_batch=100, maxsize=1000, timeout=30,
+                 min_backoff=1, max_backoff=300, encoder=None, instruments=None):
+        self._url = url
+        self._session = session
+        self._encoder = encoder
+        self._instruments = instruments or Instruments()
+        self._spool = SegmentQueue(spool_dir, max_spool_bytes)
+        self._max_batch = max_batch
+        self._timeout = timeout
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._backoff = min_backoff
+        # no request before this, after a failed one
+        self._next_retry = 0
+        self._q = Queue(maxsize=maxsize)
+        self._thread = Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self.dropped = 0
+        # batches refused with a 4xx
+        self.refused = 0
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, doc):
+        """Queue a document, never blocks; drops it if the queue is full"""
+        try:
+            self._q.put_nowait(doc)
+        except Full:
+            self.dropped += 1
+
+    def stats(self):
+        """Returns the queue's state, drops are counted since the start"""
+        return {
+            'queue_depth': self._q.qsize(),
+            'spooled_batches': len(self._spool),
+            'dropped_reports': self.dropped,
+            'dropped_batches': self._spool.dropped + self.refused,
+        }
+
+    def _collect(self, timeout):
+        try:
+            batch = [self._q.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(batch) < self._max_batch:
+            try:
+                batch.append(self._q.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _post(self, body, headers):
+        """Returns the status of the response, None if the request is to be
+        retried later"""
+        started = self._instruments.start()
+        try:
+            r = self._session.post(self._url, data=body, timeout=self._timeout,
+                                   headers=headers)
+        except Exception, e:
+            print e
+            return self._retry_later()
+        finally:
+            self._instruments.finish('report_post', started)
+        if r.status_code >= 500 or r.status_code == 429:
+            print 'gateway answered %d' % r.status_code
+            return self._retry_later()
+        self._backoff = self._min_backoff
+        if r.status_code >= 400 and r.status_code != 409:
+            print 'gateway refused a batch: %d' % r.status_code
+            self.refused += 1
+        return r.status_code
+
+    def _retry_later(self):
+        self._next_retry = monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, self._max_backoff)
+        return None
+
+    def _send(self, body):
+        """False if body has to be retried; a refused one is done with"""
+        return self._post(body, self.JSON_HEADERS) is not None
+
+    def _send_batch(self, batch):
+        """Sends a batch that was not spilled, False if it has to be"""
+        if not self._encoder:
+            return self._send(gzip_compress(json.dumps(batch)))
+        status = self._post(self._encoder.encode(batch), self.WIRE_HEADERS)
+        if status == 409:
+            # the gateway lost the frames ours are deltas to
+            self._encoder.reset()
+            status = self._post(self._encoder.encode(batch), self.WIRE_HEADERS)
+        if status is None or status == 409:
+            return False
+        if status < 400:
+            # a refused body left the gateway's stream as it was
+            self._encoder.commit()
+        return True
+
+    def _run(self):
+        while True:
+            # while something is spilled, wake up to retry it once the
+            # backoff is over; batches arriving before that are spilled
+            timeout = None
+            if self._spool:
+                timeout = max(0, self._next_retry - monotonic())
+            batch = self._collect(timeout)
+            if batch:
+                if self._spool or not self._send_batch(batch):
+                    self._spool.append(gzip_compress(json.dumps(batch)))
+            if monotonic() < self._next_retry:
+                continue
+            while self._spool:
+                if not self._send(self._spool.peek()):
+                    break
+                self._spool.pop()
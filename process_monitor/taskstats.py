@@ -1,11 +1,20 @@
 import os
-import time
 import errno
+import socket
 import pprint
 import struct
-
-from iotop.netlink import Connection, NETLINK_GENERIC, U32Attr, NLM_F_REQUEST
+import heapq
+import multiprocessing
+from array import array
+from itertools import izip
+from operator import add
+
+from iotop.netlink import Connection, NETLINK_GENERIC, NulStrAttr
+from iotop.netlink import NLM_F_REQUEST
 from iotop.genetlink import Controller, GeNlMessage
+from procfs import ProcReader
+from clock import monotonic
+from instrument import Instruments
 
 
 class DumpableObject(object):
@@ -34,8 +43,13 @@ class ProcStat(object):
     @classmethod
     def proc(cls, pid):
         with open('/proc/%d/stat' % pid) as f:
-            vs = f.read().split(' ')
-            return dict(zip(cls._columns, vs))
+            stat = f.read()
+        # tcomm may contain spaces, split around it
+        comm_start = stat.index('(')
+        comm_end = stat.rindex(')')
+        vs = ([stat[:comm_start - 1], stat[comm_start:comm_end + 1]] +
+              stat[comm_end + 2:].split(' '))
+        return dict(zip(cls._columns, vs))
 
 
 
@@ -43,18 +57,25 @@ class Stats(DumpableObject):
     members_offsets = [
         ('blkio_delay_total', 40),
         ('swapin_delay_total', 56),
+        ('ac_utime', 152),  # microseconds
+        ('ac_stime', 160),
         ('read_bytes', 248),
         ('write_bytes', 256),
         ('cancelled_write_bytes', 264)
     ]
 
+    members_names = [name for name, offset in members_offsets]
+
+    # one unpack for all the members, skipping the fields in between
+    members_struct = struct.Struct(''.join(
+        '%dxQ' % (offset - prev_end) for (name, offset), prev_end in
+        zip(members_offsets, [0] + [o + 8 for n, o in members_offsets])))
+
     has_blkio_delay_total = False
 
-    def __init__(self, task_stats_buffer):
-        sd = self.__dict__
-        for name, offset in Stats.members_offsets:
-            data = task_stats_buffer[offset:offset + 8]
-            sd[name] = struct.unpack('Q', data)[0]
+    def __init__(self, task_stats_buffer, buffer_offset=0):
+        self.__dict__.update(zip(Stats.members_names,
+            Stats.members_struct.unpack_from(task_stats_buffer, buffer_offset)))
 
         # This is a heuristic to detect if CONFIG_TASK_DELAY_ACCT is enabled in
         # the kernel.
@@ -121,112 +142,611 @@ but when i test it, found that it does not including I/O accounting,that is read
 are all zero, not the sum of each thread's read_bytes&write_bytes
 
 so i have to make sum of each thread's account in the thread group in user space:(
-    
+
+/proc/<pid>/io does have the thread group's I/O, including that of threads which
+exited, see ProcessCounter's proc_io mode; it lacks the delay accounting fields.
 """
 
-class TaskCounter(object):
-    def __init__(self, tid):
-        self._tid = tid
-        self._request = GeNlMessage(TaskStatHelper.family_id, cmd=TASKSTATS_CMD_GET,
-                           attrs=[U32Attr(TASKSTATS_CMD_ATTR_PID, self._tid)],
-                           flags=NLM_F_REQUEST)
-        self._stats_total = None
-        self._stats_delta = Stats.build_all_zero()
-        self.duration = None
-        self._timestamp = time.time()
-
-    def _update_stats(self, stats):
-        if not self._stats_total:
-            self._stats_total = stats
-        stats.delta(self._stats_total, self._stats_delta)
-        self._stats_total = stats
-
-    def update_task_stats(self):
-        t0 = time.time()
-        self.duration = t0 - self._timestamp
-        self._timestamp = t0
-        self._request.send(TaskStatHelper.connection)
-        try:
-            reply = GeNlMessage.recv(TaskStatHelper.connection)
-        except OSError as e:
-            if e.errno == errno.ESRCH:
-                # OSError: Netlink error: No such process (3)
-                return
-            raise
-        for attr_type, attr_value in reply.attrs.items():
-            #if attr_type == TASKSTATS_TYPE_AGGR_TGID:
-            if attr_type == TASKSTATS_TYPE_AGGR_PID:
-                reply = attr_value.nested()
-                break
+
+_u32 = struct.Struct('I')
+
+
+def _reply_stats(reply):
+    """Returns the TASKSTATS_TYPE_STATS attribute of a reply, or None"""
+    for attr_type, attr_value in reply.attrs.items():
+        #if attr_type == TASKSTATS_TYPE_AGGR_TGID:
+        if attr_type == TASKSTATS_TYPE_AGGR_PID:
+            reply = attr_value.nested()
+            break
+    else:
+        return
+    taskstats_data = reply[TASKSTATS_TYPE_STATS]
+    if len(taskstats_data) < 272:
+        # Short reply
+        return
+    taskstats_version = taskstats_data.u16()
+    assert taskstats_version >= 4
+    return taskstats_data
+
+
+class TaskStatsTable(object):
+    """Per-thread taskstats kept in columns, one row per tid.
+
+    The last total and the last delta of every Stats member live in
+    preallocated arrays instead of two Stats objects per thread.  Rows of
+    exited threads are recycled, and the sums for a process are reduced
+    over its rows column by column.
+    """
+    def __init__(self, capacity=1024):
+        self._capacity = 0
+        self._size = 0
+        self._free_rows = []
+        self._tids = array('l')
+        self._timestamps = array('d')
+        self._durations = array('d')
+        self._sampled = array('b')
+        self._totals = [array('L') for name in Stats.members_names]
+        self._deltas = [array('l') for name in Stats.members_names]
+        self._delta_columns = dict(zip(Stats.members_names, self._deltas))
+        self._grow(capacity)
+
+    def _columns(self):
+        return ([self._tids, self._timestamps, self._durations, self._sampled] +
+                self._totals + self._deltas)
+
+    def _grow(self, capacity):
+        extra = capacity - self._capacity
+        for column in self._columns():
+            column.extend(array(column.typecode, [0]) * extra)
+        self._capacity = capacity
+
+    def __len__(self):
+        return self._size - len(self._free_rows)
+
+    def add(self, tid):
+        """Allocate a row for tid, returns the row"""
+        if self._free_rows:
+            row = self._free_rows.pop()
         else:
+            if self._size == self._capacity:
+                self._grow(self._capacity * 2)
+            row = self._size
+            self._size += 1
+        self._tids[row] = tid
+        self._timestamps[row] = monotonic()
+        self._durations[row] = 0
+        self._sampled[row] = 0
+        return row
+
+    def remove(self, row):
+        self._free_rows.append(row)
+
+    def tid(self, row):
+        return self._tids[row]
+
+    def update(self, row, task_stats_buffer, buffer_offset, timestamp):
+        """Record a new taskstats total for row, read from the buffer"""
+        self.update_values(row, Stats.members_struct.unpack_from(
+                                task_stats_buffer, buffer_offset), timestamp)
+
+    def update_values(self, row, values, timestamp):
+        """Record a new total for row, values in Stats.members_names order"""
+        self._durations[row] = timestamp - self._timestamps[row]
+        self._timestamps[row] = timestamp
+        if self._sampled[row]:
+            for total, delta, value in zip(self._totals, self._deltas, values):
+                delta[row] = value - total[row]
+                total[row] = value
+        else:
+            # the first sample only sets the baseline
+            for total, delta, value in zip(self._totals, self._deltas, values):
+                delta[row] = 0
+                total[row] = value
+            self._sampled[row] = 1
+
+        if not Stats.has_blkio_delay_total:
+            Stats.has_blkio_delay_total = values[0] != 0
+
+    def finish(self, row, values):
+        """Record the final total of an exited task and release its row,
+        returns the last deltas"""
+        self.update_values(row, values, monotonic())
+        self.remove(row)
+        return [delta[row] for delta in self._deltas]
+
+    def reduce(self, rows, top=0):
+        """Returns (Stats of the summed deltas, summed durations, hottest)
+        of rows
+
+        With top=k, hottest are the rows with the k largest deltas of
+        read_bytes, of write_bytes or of CPU time, at most 3k of them; an
+        empty set otherwise.  The heaps of k rows are fed from the same
+        gathered columns as the sums, no column is read twice.
+        """
+        stats = Stats.build_all_zero()
+        sd = stats.__dict__
+        hottest = set()
+        if not top:
+            for name, delta in zip(Stats.members_names, self._deltas):
+                sd[name] = sum(map(delta.__getitem__, rows))
+            return stats, sum(map(self._durations.__getitem__, rows)), hottest
+        columns = {}
+        for name, delta in zip(Stats.members_names, self._deltas):
+            values = columns[name] = map(delta.__getitem__, rows)
+            sd[name] = sum(values)
+        cpu = map(add, columns['ac_utime'], columns['ac_stime'])
+        for values in (columns['read_bytes'], columns['write_bytes'], cpu):
+            hottest.update(row for (value, row) in
+                           heapq.nlargest(top, izip(values, rows)) if value > 0)
+        return stats, sum(map(self._durations.__getitem__, rows)), hottest
+
+    def rates(self, row):
+        """Returns (tid, read_bytes/s, write_bytes/s, CPU seconds/s) of the
+        last delta of row"""
+        duration = self._durations[row]
+        if not duration:
+            return (self._tids[row], 0, 0, 0.0)
+        delta = self._delta_columns
+        return (self._tids[row],
+                int(delta['read_bytes'][row] / duration),
+                int(delta['write_bytes'][row] / duration),
+                (delta['ac_utime'][row] + delta['ac_stime'][row]) * 1e-6 / duration)
+
+
+class TaskStatsBatch(object):
+    """Pipelined taskstats queries on one netlink connection.
+
+    Requests for up to `window` tasks are packed into a single send.  The
+    kernel answers generic netlink requests synchronously while handling
+    the send, so once it returns every reply is already queued on the
+    socket and can be drained without blocking, matched back to its task
+    by sequence number.  Replies that did not fit in the receive buffer
+    are dropped by the kernel; those tasks simply miss this round.
+
+    The requests are serialized once, into a buffer of `window` of them;
+    a query only writes the sequence number and tid of each in place.
+    """
+    # a TASKSTATS_CMD_GET request: nlmsghdr, genlmsghdr, the u32 pid attribute
+    _request = struct.Struct('IHHIIBBxxHHI')
+    # where the seq and the tid are in it
+    _seq_offset = 8
+    _tid_offset = 24
+
+    def __init__(self, connection=None, family_id=None, window=64):
+        self._connection = connection or TaskStatHelper.connection
+        self._family_id = family_id or TaskStatHelper.family_id
+        self._window = window
+        size = self._request.size
+        self._requests = bytearray(size * window)
+        for i in xrange(window):
+            self._request.pack_into(self._requests, i * size, size,
+                                    self._family_id, NLM_F_REQUEST, 0,
+                                    self._connection.pid, TASKSTATS_CMD_GET, 0,
+                                    8, TASKSTATS_CMD_ATTR_PID, 0)
+        self._requests_view = memoryview(self._requests)
+        # syscalls so far, for the monitor's own stats
+        self.sends = 0
+        self.recvs = 0
+
+    def query(self, table, rows):
+        """Refresh the given rows of a TaskStatsTable, returns the rows that replied"""
+        replied = []
+
+        def on_reply(row, taskstats_data, timestamp):
+            table.update(row, taskstats_data.buf, taskstats_data.offset, timestamp)
+            replied.append(row)
+
+        self._query([(table.tid(row), row) for row in rows], on_reply)
+        return replied
+
+    def query_totals(self, tids):
+        """Returns [(tid, values)] for the tasks that replied, values are the
+        totals in Stats.members_names order"""
+        totals = []
+        unpack = Stats.members_struct.unpack_from
+
+        def on_reply(tid, taskstats_data, timestamp):
+            totals.append((tid, unpack(taskstats_data.buf, taskstats_data.offset)))
+
+        self._query([(tid, tid) for tid in tids], on_reply)
+        return totals
+
+    def _query(self, tasks, on_reply):
+        for i in xrange(0, len(tasks), self._window):
+            self._query_window(tasks[i:i + self._window], on_reply)
+
+    def _query_window(self, tasks, on_reply):
+        """tasks are (tid, key) pairs, on_reply(key, taskstats_data, timestamp)
+        is called for each task that replied"""
+        conn = self._connection
+        pending = {}
+        requests = self._requests
+        pack_u32 = _u32.pack_into
+        (seq_offset, tid_offset) = (self._seq_offset, self._tid_offset)
+        offset = 0
+        size = self._request.size
+        timestamp = monotonic()
+        for tid, key in tasks:
+            seq = conn.seq()
+            pack_u32(requests, offset + seq_offset, seq)
+            pack_u32(requests, offset + tid_offset, tid)
+            pending[seq] = key
+            offset += size
+        if offset < len(requests):
+            conn.send(self._requests_view[:offset])
+        else:
+            conn.send(requests)
+        self.sends += 1
+        conn.descriptor.setblocking(0)
+        try:
+            while pending:
+                self.recvs += 1
+                try:
+                    reply = GeNlMessage.recv(conn)
+                except OSError as e:
+                    if e.errno == errno.ESRCH:
+                        # the thread exited after we listed it
+                        pending.pop(e.seq, None)
+                        continue
+                    raise
+                except socket.error as e:
+                    if e.errno == errno.ENOBUFS:
+                        # some replies overflowed the receive buffer, the
+                        # ones queued before that are still readable
+                        continue
+                    if e.errno == errno.EAGAIN:
+                        # the remaining replies were dropped by the kernel
+                        break
+                    raise
+                key = pending.pop(reply.seq, None)
+                if key is None:
+                    continue
+                taskstats_data = _reply_stats(reply)
+                if taskstats_data:
+                    on_reply(key, taskstats_data, timestamp)
+        finally:
+            conn.descriptor.setblocking(1)
+
+
+def _shard_worker(pipe):
+    # a connection of our own, the parent's socket is inherited but not ours to use
+    connection = Connection(NETLINK_GENERIC)
+    family_id = Controller(connection).get_family_id('TASKSTATS')
+    batch = TaskStatsBatch(connection, family_id)
+    while True:
+        try:
+            tids = array('l')
+            tids.fromstring(pipe.recv_bytes())
+        except EOFError:
             return
-        taskstats_data = reply[TASKSTATS_TYPE_STATS].data
-        if len(taskstats_data) < 272:
-            # Short reply
-            return
-        taskstats_version = struct.unpack('H', taskstats_data[:2])[0]
-        assert taskstats_version >= 4
-        self._update_stats(Stats(taskstats_data))
-        return self._stats_delta
+        totals = array('L')
+        for tid, values in batch.query_totals(tids):
+            totals.append(tid)
+            totals.extend(values)
+        pipe.send_bytes(totals.tostring())
+
+
+class TaskStatsShards(object):
+    """Taskstats queries spread over worker processes.
+
+    Tids are sharded across `workers` processes, each owning its own
+    generic netlink connection and family id.  The workers query and parse
+    their shard in parallel and send back the raw totals; the parent only
+    records those in the TaskStatsTable, after which every process sums
+    its rows as usual.  Processes rather than threads, since most of a
+    query is spent parsing in Python.  Create it before starting threads,
+    the workers are forked.
+    """
+    def __init__(self, workers):
+        self._pipes = []
+        for i in range(workers):
+            parent_end, child_end = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_shard_worker, args=(child_end,))
+            worker.daemon = True
+            worker.start()
+            child_end.close()
+            self._pipes.append(parent_end)
+
+    def query(self, table, rows):
+        """Refresh the given rows of a TaskStatsTable, returns the rows that replied"""
+        shards = [array('l') for pipe in self._pipes]
+        row_of_tid = {}
+        for row in rows:
+            tid = table.tid(row)
+            row_of_tid[tid] = row
+            shards[tid % len(shards)].append(tid)
+        timestamp = monotonic()
+        for pipe, tids in zip(self._pipes, shards):
+            pipe.send_bytes(tids.tostring())
+
+        replied = []
+        width = 1 + len(Stats.members_names)
+        for pipe in self._pipes:
+            totals = array('L')
+            totals.fromstring(pipe.recv_bytes())
+            for i in xrange(0, len(totals), width):
+                row = row_of_tid[totals[i]]
+                table.update_values(row, totals[i + 1:i + width], timestamp)
+                replied.append(row)
+        return replied
+
+
+SO_RCVBUFFORCE = 33
+
+
+class TaskExitListener(object):
+    """Final taskstats of exiting tasks, pushed by the kernel.
+
+    A dedicated netlink socket is registered with
+    TASKSTATS_CMD_ATTR_REGISTER_CPUMASK, after which the kernel sends the
+    stats of every task that exits on one of those cpus.  This catches
+    the I/O of threads that exit between two polls, including threads
+    that were never polled at all.  Exit storms are absorbed by a large
+    receive buffer; messages lost anyway are counted in `dropped`.
+    """
+    def __init__(self, cpumask=None, rcvbuf=16 << 20):
+        if cpumask is None:
+            cpumask = '0-%d' % (os.sysconf('SC_NPROCESSORS_CONF') - 1)
+        self.dropped = 0
+        self._connection = Connection(NETLINK_GENERIC)
+        try:
+            self._connection.descriptor.setsockopt(socket.SOL_SOCKET,
+                                                   SO_RCVBUFFORCE, rcvbuf)
+        except socket.error:
+            # needs CAP_NET_ADMIN, otherwise capped by rmem_max
+            self._connection.descriptor.setsockopt(socket.SOL_SOCKET,
+                                                   socket.SO_RCVBUF, rcvbuf)
+        self._cpumask = cpumask
+        self._register(TASKSTATS_CMD_ATTR_REGISTER_CPUMASK)
+
+    def _register(self, cmd_attr):
+        request = GeNlMessage(TaskStatHelper.family_id, cmd=TASKSTATS_CMD_GET,
+                              attrs=[NulStrAttr(cmd_attr, self._cpumask)],
+                              flags=NLM_F_REQUEST)
+        request.send(self._connection)
+
+    def close(self):
+        self._register(TASKSTATS_CMD_ATTR_DEREGISTER_CPUMASK)
+        self._connection.descriptor.close()
+
+    def recv(self):
+        """Wait for the next exit, returns (tid, tgid, values)
+
+        values are the final totals in Stats.members_names order.  tgid
+        is None on kernels whose taskstats (before version 12) don't
+        carry ac_tgid.
+        """
+        while True:
+            try:
+                reply = GeNlMessage.recv(self._connection)
+            except socket.error as e:
+                if e.errno == errno.ENOBUFS:
+                    self.dropped += 1
+                    continue
+                raise
+            aggr = reply.attrs.get(TASKSTATS_TYPE_AGGR_PID)
+            if aggr is None:
+                continue
+            aggr = aggr.nested()
+            taskstats_data = aggr[TASKSTATS_TYPE_STATS]
+            if len(taskstats_data) < 272:
+                continue
+            tgid = None
+            if taskstats_data.u16() >= 12 and len(taskstats_data) >= 372:
+                tgid = struct.unpack_from('I', taskstats_data.buf,
+                                          taskstats_data.offset + 368)[0]
+            values = Stats.members_struct.unpack_from(taskstats_data.buf,
+                                                      taskstats_data.offset)
+            return (aggr[TASKSTATS_TYPE_PID].u32(), tgid, values)
 
 
 class ProcessCounter(object):
-    def __init__(self, pid):
+    """Resource usage of a process, from taskstats of each of its threads.
+
+    With proc_io the I/O is read from /proc/<pid>/io instead: one read per
+    round rather than a taskstats query per thread, and exited threads are
+    already accounted for.  Only read_bytes, write_bytes and
+    cancelled_write_bytes are filled then, the delay totals stay 0, and
+    the counter keeps no threads.  A process whose io file can't be read
+    is counted from taskstats.
+
+    With top_threads=k, top_threads lists after every round the threads
+    with the k highest read_bytes, write_bytes or CPU rates, with their
+    comm; only those threads' comm files are read.  It stays empty in the
+    proc_io mode.
+    """
+    # fields of /proc/<pid>/stat, see proc(5)
+    _stat_fields = (24, 23, 15, 14, 20)  # rss, vsize, stime, utime, num_threads
+    # fields of /proc/<pid>/io for the proc_io mode, named as in Stats
+    _io_fields = ('read_bytes', 'write_bytes', 'cancelled_write_bytes')
+
+    def __init__(self, pid, task_table=None, proc_reader=None, batch=None,
+                 instruments=None, proc_io=False, top_threads=0):
         self._pid = pid
-        self._task_counters = {}
+        self._top_threads = top_threads
+        self.top_threads = []
+        self._proc_io = proc_io
+        self._task_table = task_table if task_table is not None else TaskStatsTable()
+        self._proc_reader = proc_reader or ProcReader()
+        self._task_rows = {}
+        # rows of threads that went away, kept for one more round in case
+        # their exit notification is still on its way
+        self._vanished_rows = {}
+        self._exited_delta = Stats.build_all_zero()
+        self._tids_listed = False
+        self._batch = batch or TaskStatsBatch()
+        self._instruments = instruments or Instruments()
         (self._rss, self._vm, self._stime, self._utime, self._num_threads) = self._get_proc()
-        self._timestamp = time.time()
-
-    def update_tasks_stats(self):
-        self._update_tids()
-        tasks_delta = Stats.build_all_zero()
-        total_duration = 0
-        for task_counter in self._task_counters.values():
-            t = task_counter.update_task_stats()
-            if t:
-                tasks_delta.accumulate(t, tasks_delta)
-                total_duration += task_counter.duration
-        if not self._task_counters:
+        if proc_io:
+            try:
+                self._io = self._proc_reader.io_fields(pid, self._io_fields)
+            except IOError as e:
+                if e.errno != errno.EACCES:
+                    raise
+                # not ours to read, taskstats still works with CAP_NET_ADMIN
+                self._proc_io = False
+        self._timestamp = monotonic()
+
+    def update_tasks_stats(self, rescan_tids=True):
+        """rescan_tids=False relies on add_tid/remove_tid to keep the
+        thread list current, e.g. from proc connector events"""
+        if self._proc_io:
+            return self._update_proc_io()
+        rows = self.task_rows(rescan_tids)
+        started = self._instruments.start()
+        rows = self._batch.query(self._task_table, rows)
+        self._instruments.finish('netlink', started)
+        return self.account_tasks(rows)
+
+    def task_rows(self, rescan_tids=True):
+        """Returns the task table rows to query this round"""
+        self._release_vanished()
+        if rescan_tids or not self._tids_listed:
+            self._update_tids()
+        return self._task_rows.values()
+
+    def account_tasks(self, rows):
+        """Sum up the rows refreshed this round, see update_tasks_stats"""
+        if not self._task_rows:
             return (None, None, None, None, None, None)
+        tasks_delta, total_duration, hottest = self._task_table.reduce(
+                                                    rows, self._top_threads)
+        tasks_delta.accumulate(self._exited_delta, tasks_delta)
+        self._exited_delta = Stats.build_all_zero()
+        if self._top_threads:
+            self.top_threads = self._hottest_threads(hottest)
+        return self._account(tasks_delta, int(total_duration/len(self._task_rows)))
+
+    def _hottest_threads(self, hottest):
+        threads = []
+        for row in hottest:
+            (tid, read_bytes, write_bytes, cpu_usage) = self._task_table.rates(row)
+            comm = self._thread_comm(tid)
+            if comm is None:
+                # gone already
+                continue
+            threads.append({'tid': tid, 'comm': comm, 'read_bytes': read_bytes,
+                            'write_bytes': write_bytes, 'cpu_usage': cpu_usage})
+        return threads
+
+    def _thread_comm(self, tid):
+        try:
+            with open('%s/%d/task/%d/comm' % (self._proc_reader.root,
+                                              self._pid, tid)) as f:
+                return f.read().rstrip('\n')
+        except IOError:
+            return None
+
+    def _update_proc_io(self):
+        started = self._instruments.start()
+        try:
+            io = self._proc_reader.io_fields(self._pid, self._io_fields)
+        except IOError as e:
+            if e.errno not in (errno.ENOENT, errno.ESRCH):
+                raise
+            # exited since the last round, like a process without threads
+            return (None, None, None, None, None, None)
+        finally:
+            self._instruments.finish('proc_io', started)
+        delta = Stats.build_all_zero()
+        sd = delta.__dict__
+        for (name, value, previous) in zip(self._io_fields, io, self._io):
+            sd[name] = value - previous
+        self._io = io
+        # the same span cpu_usage is computed over
+        return self._account(delta, int(monotonic() - self._timestamp))
+
+    def _account(self, tasks_delta, io_duration):
+        """Adds the /proc/<pid>/stat numbers to the I/O delta of a round"""
+        started = self._instruments.start()
         (rss, vm, stime, utime, num_threads) = self._get_proc()
-        t = time.time()
+        self._instruments.finish('proc_stat', started)
+        t = monotonic()
         duration = t - self._timestamp
         self._timestamp = t
         diff_stime = stime - self._stime
         diff_utime = utime - self._utime
         (self._rss, self._vm, self._stime, self._utime, self._num_threads) = (rss, vm, stime, utime, num_threads)
         cpu_usage = ((diff_stime + diff_utime) / duration)
-        return (cpu_usage, self._num_threads, self._vm, self._rss, tasks_delta, int(total_duration/len(self._task_counters)))
+        return (cpu_usage, self._num_threads, self._vm, self._rss, tasks_delta, io_duration)
+
+    def add_tid(self, tid):
+        if self._proc_io:
+            return
+        if tid not in self._task_rows:
+            self._task_rows[tid] = self._task_table.add(tid)
+
+    def remove_tid(self, tid):
+        row = self._task_rows.pop(tid, None)
+        if row is not None:
+            self._vanished_rows[tid] = row
+
+    def has_tid(self, tid):
+        return tid in self._task_rows or tid in self._vanished_rows
+
+    def task_exited(self, tid, values):
+        """Fold the final taskstats of an exited thread into the next delta"""
+        if self._proc_io:
+            # /proc/<pid>/io has it already
+            return
+        row = self._task_rows.pop(tid, None)
+        if row is None:
+            row = self._vanished_rows.pop(tid, None)
+        if row is not None:
+            values = self._task_table.finish(row, values)
+        elif not self._tids_listed:
+            # may have been running long before we started watching
+            return
+        # otherwise it lived and died between two polls, all of it is new
+        sd = self._exited_delta.__dict__
+        for name, value in zip(Stats.members_names, values):
+            sd[name] += value
+
+    def close(self):
+        """Release the task table rows and /proc descriptors of this process"""
+        self._proc_reader.evict(self._pid)
+        self._release_vanished()
+        for row in self._task_rows.values():
+            self._task_table.remove(row)
+        self._task_rows = {}
+
+    def _release_vanished(self):
+        for row in self._vanished_rows.values():
+            self._task_table.remove(row)
+        self._vanished_rows = {}
 
     def _get_proc(self):
-        stat = ProcStat.proc(self._pid)
-        rss = int(stat['rss'])*4*1024
-        vm  = int(stat['vsize'])
+        (rss, vm, stime, utime, num_threads) = self._proc_reader.stat_fields(
+                                                    self._pid, self._stat_fields)
+        rss = rss*4*1024
         #HZ is 1/100
-        stime = int(stat['stime']) * 0.01 #seconds
-        utime = int(stat['utime']) * 0.01
-        num_threads = stat['num_threads']
+        stime = stime * 0.01 #seconds
+        utime = utime * 0.01
         return (rss, vm, stime, utime, num_threads)
 
     def _update_tids(self):
+        started = self._instruments.start()
         self._compute_diff_tids()
+        self._instruments.finish('list_tids', started)
 
     def _list_tids(self):
         try:
-            tids = list(map(int, os.listdir('/proc/%d/task' % self._pid)))
+            tids = list(map(int, os.listdir('%s/%d/task' % (self._proc_reader.root,
+                                                            self._pid))))
         except OSError:
             return []
         return tids
 
     def _compute_diff_tids(self):
         tids = self._list_tids()
-        old_tids = self._task_counters.keys()
+        old_tids = self._task_rows.keys()
         died_tids = set(old_tids) - set(tids)
         new_tids = set(tids) - set(old_tids)
         for tid in new_tids:
-            self._task_counters[tid] = TaskCounter(tid)
+            self.add_tid(tid)
         for tid in died_tids:
-            self._task_counters.pop(tid)
+            self.remove_tid(tid)
+        self._tids_listed = True
 
 
 if __name__ == '__main__':
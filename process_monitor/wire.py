@@ -0,0 +1,429 @@
+"""Compact binary encoding of the monitor's reports.
+
+A body is MAGIC followed by one frame per report document:
+
+    flags        byte, KEYFRAME and THREADS
+    seq          varint, frame number of the host's stream
+    host         string
+    time         zigzag varint, delta to the previous frame's time,
+                 the time itself in keyframes
+    [fields]     keyframes only: varint count, then per field its name
+                 (string) and type (byte 'i' or 'f')
+    [services]   keyframes only: varint count, then the names (strings)
+    entries      varint length in bytes of the entries: the count of
+                 entries n and the n bitmaps of the fields present as
+                 varints, a column of the n service indexes, then one
+                 column per field of the n deltas to the previous values
+    [threads]    THREADS only: string, the JSON list of [entry index,
+                 threads] of the entries with a 'threads' list
+
+A column is a byte, the width of its deltas (0, 1, 2, 4 or 8), and the
+n deltas as little endian signed integers of that width; a width of 0
+means all of them are 0 and takes no more bytes.  An absent field has a
+delta of 0.  Each column is packed and unpacked by a single struct call,
+so neither side loops over the values one by one.
+
+Strings are a varint length and UTF-8.  Floats travel as thousandths.
+The threads lists of the hottest threads are few and irregular, they
+travel as they are, not delta encoded.
+Field and service names are sent once, in a keyframe, and referenced by
+index afterwards; a keyframe also resets all previous values to 0, so
+its deltas are the values themselves.
+
+The decoder keeps the dictionary and the previous values per host.  A
+delta frame which does not follow the last frame it saw of that host
+raises ResyncError, the gateway answers 409, and the encoder starts over
+with a keyframe.
+"""
+import json
+import struct
+from operator import add, sub, div
+
+MAGIC = 'PMW\x02'
+CONTENT_TYPE = 'application/x-process-monitor-wire'
+
+KEYFRAME = 1
+THREADS = 2
+
+FLOAT_SCALE = 1000
+
+# column widths and their struct codes
+_WIDTHS = ((1, 'b'), (2, 'h'), (4, 'i'), (8, 'q'))
+_CODES = dict(_WIDTHS)
+
+
+class ResyncError(Exception):
+    """A delta frame without the frame it is based on"""
+
+
+def write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def write_varints(buf, values):
+    append = buf.append
+    for value in values:
+        while value > 0x7f:
+            append((value & 0x7f) | 0x80)
+            value >>= 7
+        append(value)
+
+
+def zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def write_zigzag(buf, value):
+    write_varint(buf, zigzag(value))
+
+
+def read_varints(data, offset, n):
+    """Returns (the n varints at offset of the bytearray data, the offset
+    after them)"""
+    values = []
+    append = values.append
+    for i in xrange(n):
+        b = data[offset]
+        offset += 1
+        if b < 0x80:
+            append(b)
+            continue
+        value = b & 0x7f
+        shift = 7
+        while True:
+            b = data[offset]
+            offset += 1
+            value |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(value)
+    return (values, offset)
+
+
+def write_string(buf, s):
+    s = s.encode('utf-8')
+    write_varint(buf, len(s))
+    buf.extend(s)
+
+
+def write_column(buf, column):
+    """Appends the deltas of one field, in the narrowest width"""
+    lo = min(column)
+    hi = max(column)
+    if lo == hi == 0:
+        buf.append(0)
+        return
+    for (width, code) in _WIDTHS:
+        limit = 1 << (8 * width - 1)
+        if -limit <= lo and hi < limit:
+            break
+    buf.append(width)
+    buf.extend(struct.pack('<%d%s' % (len(column), code), *column))
+
+
+class Reader(object):
+
+    def __init__(self, data, offset=0):
+        self._data = bytearray(data)
+        self.offset = offset
+
+    def at_end(self):
+        return self.offset >= len(self._data)
+
+    def byte(self):
+        value = self._data[self.offset]
+        self.offset += 1
+        return value
+
+    def varint(self):
+        data = self._data
+        offset = self.offset
+        value = 0
+        shift = 0
+        while True:
+            b = data[offset]
+            offset += 1
+            value |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.offset = offset
+        return value
+
+    def zigzag(self):
+        return unzigzag(self.varint())
+
+    def varints(self, n):
+        (values, self.offset) = read_varints(self._data, self.offset, n)
+        return values
+
+    def column(self, n):
+        """Returns the n deltas of the next column"""
+        width = self.byte()
+        if not width:
+            return (0,) * n
+        values = struct.unpack_from('<%d%s' % (n, _CODES[width]), self._data, self.offset)
+        self.offset += n * width
+        return values
+
+    def string(self):
+        n = self.varint()
+        s = self._data[self.offset:self.offset + n]
+        if len(s) < n:
+            raise IndexError('truncated string')
+        self.offset += n
+        return str(s).decode('utf-8')
+
+
+class Stream(object):
+    """What both sides remember of a host's frames
+
+    previous maps a service index to the list of the last values of its
+    fields, by field index.  Those lists are replaced, never changed, so
+    a copy of the stream shares them.
+    """
+
+    def __init__(self, fields=(), services=()):
+        self.seq = -1
+        self.time = 0
+        self.fields = list(fields)
+        self.names = [name for (name, kind) in self.fields]
+        self.floats = [f for (f, (name, kind)) in enumerate(self.fields) if kind == 'f']
+        # what the decoder divides the values by, the ints stay ints
+        self.scales = [float(FLOAT_SCALE) if kind == 'f' else 1
+                       for (name, kind) in self.fields]
+        self.services = list(services)
+        self.service_index = dict((name, s) for (s, name) in enumerate(self.services))
+        self.previous = {}
+
+    def copy(self):
+        # the dictionary is never changed either, only replaced
+        stream = Stream.__new__(Stream)
+        stream.__dict__.update(self.__dict__)
+        stream.previous = dict(self.previous)
+        return stream
+
+
+def _type_of(value, known=None):
+    # once a float, a field stays one, ints travel fine as floats
+    return 'f' if isinstance(value, float) or known == 'f' else 'i'
+
+
+class Encoder(object):
+    """Encodes the report documents of one host
+
+    encode() leaves the stream as it was; call commit() once the gateway
+    has accepted the body, and reset() when it asked for a resync.
+    """
+
+    def __init__(self):
+        self._stream = None
+        self._pending = None
+
+    def reset(self):
+        self._stream = None
+
+    def commit(self):
+        self._stream = self._pending
+
+    def encode(self, docs):
+        buf = bytearray(MAGIC)
+        stream = self._stream.copy() if self._stream else None
+        for doc in docs:
+            stream = self._encode_doc(buf, stream, doc)
+        self._pending = stream
+        return str(buf)
+
+    def _keyframe_stream(self, stream, doc):
+        # keep the indexes of the names already known, add the new ones
+        fields = list(stream.fields) if stream else []
+        services = list(stream.services) if stream else []
+        index = dict((name, f) for (f, (name, t)) in enumerate(fields))
+        for entry in doc['list']:
+            if entry['service'] not in services:
+                services.append(entry['service'])
+            for (name, value) in sorted(entry['data'].iteritems()):
+                if name in index:
+                    f = index[name]
+                    fields[f] = (name, _type_of(value, fields[f][1]))
+                else:
+                    index[name] = len(fields)
+                    fields.append((name, _type_of(value)))
+        seq = stream.seq if stream else -1
+        stream = Stream(fields, services)
+        stream.seq = seq
+        return stream
+
+    def _encode_doc(self, buf, stream, doc):
+        entries = None
+        if stream is not None:
+            # None if doc has a name or type the stream does not know yet
+            entries = self._encode_entries(stream, doc)
+        keyframe = entries is None
+        if keyframe:
+            stream = self._keyframe_stream(stream, doc)
+            entries = self._encode_entries(stream, doc)
+        stream.seq += 1
+        threads = [[i, entry['threads']] for (i, entry) in enumerate(doc['list'])
+                   if 'threads' in entry]
+
+        buf.append((KEYFRAME if keyframe else 0) | (THREADS if threads else 0))
+        write_varint(buf, stream.seq)
+        write_string(buf, doc['host'])
+        t = int(doc.get('time') or 0)
+        write_zigzag(buf, t - (0 if keyframe else stream.time))
+        stream.time = t
+        if keyframe:
+            write_varint(buf, len(stream.fields))
+            for (name, kind) in stream.fields:
+                write_string(buf, name)
+                buf.append(ord(kind))
+            write_varint(buf, len(stream.services))
+            for name in stream.services:
+                write_string(buf, name)
+        write_varint(buf, len(entries))
+        buf.extend(entries)
+        if threads:
+            write_string(buf, json.dumps(threads))
+        return stream
+
+    def _encode_entries(self, stream, doc):
+        names = stream.names
+        floats = stream.floats
+        service_index = stream.service_index
+        previous = stream.previous
+        nfields = len(names)
+        full = (1 << nfields) - 1
+        zeros = [0] * nfields
+        indexes = []
+        presents = []
+        rows = []
+        for entry in doc['list']:
+            s = service_index.get(entry['service'])
+            if s is None:
+                return None
+            data = entry['data']
+            values = map(data.get, names)
+            for f in floats:
+                value = values[f]
+                if value is not None:
+                    values[f] = int(round(value * FLOAT_SCALE))
+            if float in map(type, values):
+                # a float in an int field
+                return None
+            last = previous.get(s, zeros)
+            if None in values:
+                present = 0
+                for (f, value) in enumerate(values):
+                    if value is None:
+                        values[f] = last[f]
+                    else:
+                        present |= 1 << f
+                count = bin(present).count('1')
+            else:
+                present = full
+                count = nfields
+            if count != len(data):
+                # a field the stream does not have
+                return None
+            rows.append(map(sub, values, last))
+            previous[s] = values
+            indexes.append(s)
+            presents.append(present)
+        entries = bytearray()
+        write_varints(entries, [len(rows)] + presents)
+        if rows:
+            write_column(entries, indexes)
+            for column in zip(*rows):
+                write_column(entries, column)
+        return entries
+
+
+class Decoder(object):
+    """Decodes bodies into report documents, keeping a stream per host
+
+    Not thread safe, the gateway serializes decode() calls.
+    """
+
+    def __init__(self):
+        self._streams = {}
+
+    def decode(self, body):
+        """Returns the documents of body
+
+        The streams are only updated if every frame decodes, a body which
+        raises leaves them as they were.
+        """
+        if not body.startswith(MAGIC):
+            raise ValueError('not a wire body')
+        reader = Reader(body, len(MAGIC))
+        streams = {}
+        docs = []
+        while not reader.at_end():
+            docs.append(self._decode_frame(reader, streams))
+        self._streams.update(streams)
+        return docs
+
+    def _decode_frame(self, reader, streams):
+        flags = reader.byte()
+        seq = reader.varint()
+        host = reader.string()
+        stream = streams.get(host) or self._streams.get(host)
+        if flags & KEYFRAME:
+            time_base = 0
+        else:
+            if stream is None or seq != stream.seq + 1:
+                raise ResyncError(host)
+            if host not in streams:
+                stream = stream.copy()
+            time_base = stream.time
+        time = time_base + reader.zigzag()
+        if flags & KEYFRAME:
+            fields = [(reader.string(), chr(reader.byte()))
+                      for i in xrange(reader.varint())]
+            stream = Stream(fields, [reader.string() for i in xrange(reader.varint())])
+        stream.seq = seq
+        stream.time = time
+        streams[host] = stream
+
+        end = reader.varint() + reader.offset
+        n = reader.varint()
+        presents = reader.varints(n)
+        names = stream.names
+        nfields = len(names)
+        if n:
+            indexes = reader.column(n)
+            rows = zip(*[reader.column(n) for f in xrange(nfields)]) or [()] * n
+        else:
+            (indexes, rows) = ((), ())
+        if reader.offset != end:
+            raise ValueError('bad entries length')
+
+        scales = stream.scales if stream.floats else None
+        previous = stream.previous
+        services = stream.services
+        full = (1 << nfields) - 1
+        zeros = [0] * nfields
+        entries = []
+        for (s, present, row) in zip(indexes, presents, rows):
+            values = previous[s] = map(add, previous.get(s, zeros), row)
+            if scales:
+                values = map(div, values, scales)
+            if present == full:
+                data = dict(zip(names, values))
+            else:
+                data = dict((names[f], values[f]) for f in xrange(nfields)
+                            if present >> f & 1)
+            entries.append({'service': services[s], 'data': data})
+        if flags & THREADS:
+            for (i, threads) in json.loads(reader.string()):
+                entries[i]['threads'] = threads
+        return {'host': host, 'time': stream.time, 'list': entries}